@@ -1,9 +1,15 @@
+import argparse
+import functools
+import json
+import os
+import time
 from PIL import Image, ImageOps
 import numpy as np
 
-def columnwise_normalization(img, window):
-    img_array = np.array(img)
-    
+from utils.util_streaming import create_image_memmap, open_image_memmap
+
+def columnwise_normalization_array(img_array, window, dst=None):
+    """columnwise_normalization of an ndarray, into dst if given."""
     col_means = np.mean(img_array, axis = 0)
 
     smoothed_means = np.convolve(col_means, np.ones(window)/window, mode='same')
@@ -12,10 +18,60 @@ def columnwise_normalization(img, window):
 
     normalized_img = normalized_img - normalized_img.min()
     normalized_img = (normalized_img / normalized_img.max()) * 255
-    normalized_img = Image.fromarray(normalized_img.astype(np.uint8))
+    if dst is None:
+        return normalized_img.astype(np.uint8)
+    dst[...] = normalized_img
+    return dst
+
+def columnwise_normalization(img, window, strip_rows=None):
+    if strip_rows is not None:
+        img_array = np.asarray(img)
+        output = np.empty(img_array.shape, dtype=np.uint8)
+        return Image.fromarray(columnwise_normalization_strips(img_array, window, output, strip_rows))
+
+    img_array = np.array(img)
+    normalized_img = Image.fromarray(columnwise_normalization_array(img_array, window))
 
     return normalized_img
 
+def columnwise_normalization_strips(src, window, dst, strip_rows=256):
+    """columnwise_normalization of a 2D array-like read and written in strips of rows.
+
+    src and dst can be memory-mapped (see open_image_memmap/create_image_memmap); only a few
+    float32 strips are held in memory, independent of the image height. Three passes over src:
+    column means, global min/max of the mean-subtracted image, then the normalized strips are
+    written to dst (uint8). The float32 arithmetic can give one grey level less than
+    columnwise_normalization where the float64 result is within rounding of an integer.
+
+    Returns:
+        dst
+    """
+    height, width = src.shape
+    col_sums = np.zeros(width)
+    for start in range(0, height, strip_rows):
+        col_sums += src[start:start + strip_rows].sum(axis=0, dtype=np.float64)
+    smoothed_means = np.convolve(col_sums / height, np.ones(window)/window, mode='same').astype(np.float32)
+
+    strip = np.empty((strip_rows, width), dtype=np.float32)
+    low, high = np.inf, -np.inf
+    for start in range(0, height, strip_rows):
+        rows = strip[:min(strip_rows, height - start)]
+        rows[...] = src[start:start + strip_rows]
+        rows -= smoothed_means
+        low, high = min(low, rows.min()), max(high, rows.max())
+
+    scale = np.float32(255 / (high - low)) if high > low else np.float32(0)
+    for start in range(0, height, strip_rows):
+        rows = strip[:min(strip_rows, height - start)]
+        rows[...] = src[start:start + strip_rows]
+        rows -= smoothed_means
+        rows -= low
+        rows *= scale
+        dst[start:start + strip_rows] = rows
+    if isinstance(dst, np.memmap):
+        dst.flush()
+    return dst
+
 def gamma_correction(image_array, gamma):
     """Applies gamma correction to an image array with a given gamma value."""
     max_val = np.max(image_array)
@@ -50,15 +106,522 @@ def optimize_gamma_for_column(image_array, col_idx, num_neighbors = 3, gamma_ran
     
     return gamma_correction(column, best_gamma)
 
-def remove_column_noise_gamma(img, num_neighbors =3,  gamma_range=(0.5, 2.0), steps=20):
-    # Load image and convert to grayscale
-    img_array = np.array(img, dtype=np.float32)
-    
-    # Process each column independently
-    for col_idx in range(img_array.shape[1]):
-        img_array[:, col_idx] = optimize_gamma_for_column(img_array, col_idx, num_neighbors, gamma_range, steps)
-    
-    # Convert back to image and save
-    denoised_image = Image.fromarray(img_array.astype(np.uint8))
-    
-    return denoised_image
\ No newline at end of file
+def gamma_candidates(column, gammas):
+    """Applies every gamma in gammas to a column at once, exactly as gamma_correction does one by one.
+
+    Returns a (len(gammas), height) uint8 array.
+    """
+    max_val = np.max(column)
+    normalized = column / max_val
+    # np.power with one scalar gamma promotes like this, keep it for identical results
+    gammas = gammas.astype(np.result_type(normalized, gammas[0]))
+    corrected = np.power(normalized[None, :], gammas[:, None]) * max_val
+    return np.clip(corrected, 0, 255).astype(np.uint8)
+
+def _best_candidate(costs):
+    """Index of the lowest cost, None when every cost is NaN (e.g. an all-black column)."""
+    if np.isnan(costs).all():
+        return None
+    return np.nanargmin(costs)
+
+def _neighbor_means(img_array, num_neighbors):
+    """Mean of the columns col_idx-num_neighbors..col_idx+num_neighbors (clipped) for every column."""
+    width = img_array.shape[1]
+    cumsum = np.zeros((img_array.shape[0], width + 1))
+    np.cumsum(img_array, axis=1, out=cumsum[:, 1:])
+    left = np.maximum(np.arange(width) - num_neighbors, 0)
+    right = np.minimum(np.arange(width) + num_neighbors, width - 1) + 1
+    return ((cumsum[:, right] - cumsum[:, left]) / (right - left)).astype(np.float32)
+
+def _remove_column_noise_gamma_sequential(img_array, num_neighbors, gammas):
+    """Same semantics as the reference loop: corrected columns feed the neighbor means of later columns."""
+    width = img_array.shape[1]
+    for col_idx in range(width):
+        column = img_array[:, col_idx].copy()
+        left_idx = max(0, col_idx - num_neighbors)
+        right_idx = min(width - 1, col_idx + num_neighbors)
+        if left_idx == right_idx:
+            neighbor_col = img_array[:, left_idx]
+        else:
+            neighbor_col = np.mean(img_array[:, left_idx:right_idx + 1], axis=1)
+
+        candidates = gamma_candidates(column, gammas)
+        best = _best_candidate(np.abs(candidates - neighbor_col).sum(axis=1))
+        img_array[:, col_idx] = candidates[best] if best is not None else gamma_correction(column, 1.0)
+    return img_array
+
+def _remove_column_noise_gamma_independent(img_array, num_neighbors, gammas, max_block_bytes):
+    """All columns against the neighbor means of the input image, in blocks of columns."""
+    height, width = img_array.shape
+    neighbor_cols = _neighbor_means(img_array, num_neighbors)
+    block = max(1, int(max_block_bytes // (len(gammas) * height * 8)))
+    output = np.empty_like(img_array)
+
+    for start in range(0, width, block):
+        columns = np.ascontiguousarray(img_array[:, start:start + block].T)  # block x height
+        max_vals = np.max(columns, axis=1, keepdims=True)
+        normalized = columns / max_vals
+        block_gammas = gammas.astype(np.result_type(normalized, gammas[0]))
+        candidates = np.power(normalized[None], block_gammas[:, None, None]) * max_vals
+        candidates = np.clip(candidates, 0, 255).astype(np.uint8)  # gammas x block x height
+        costs = np.abs(candidates - neighbor_cols[:, start:start + block].T).sum(axis=2)
+
+        for i in range(columns.shape[0]):
+            best = _best_candidate(costs[:, i])
+            if best is not None:
+                output[:, start + i] = candidates[best, i]
+            else:
+                output[:, start + i] = gamma_correction(columns[i], 1.0)
+    return output
+
+@functools.lru_cache(maxsize=8)
+def gamma_lut(gamma_range=(0.5, 2.0), steps=20):
+    """Table of gamma_correction for uint8 columns, cached per (gamma_range, steps).
+
+    lut[gamma_idx, max_val, value] is what gamma_correction gives for a pixel value in a column
+    whose maximum is max_val, for the gamma np.linspace(*gamma_range, steps)[gamma_idx].
+    """
+    gammas = np.linspace(*gamma_range, steps)
+    values = np.arange(256, dtype=np.float32)
+    lut = np.zeros((steps, 256, 256), dtype=np.uint8)
+    for max_val in range(1, 256):
+        lut[:, max_val, :max_val + 1] = gamma_candidates(values[:max_val + 1], gammas)
+    lut.setflags(write=False)
+    return lut
+
+def _histogram_cost_fn(column, neighbor_sums, count):
+    """Cost function of one uint8 column, evaluated from a histogram of its pixel values.
+
+    The returned function maps lut rows (gammas x values, as in gamma_lut[:, max_val]) to the cost
+    of every row, sum(|corrected - neighbor mean|) scaled by count, the number of columns in the
+    neighbor mean, so everything stays in exact integer arithmetic. Pixels are grouped by value
+    and sorted by neighbor sum once; each gamma then costs one binary search per distinct value.
+    """
+    order = np.lexsort((neighbor_sums, column))
+    sorted_sums = neighbor_sums[order]
+    hist = np.bincount(column, minlength=256)
+    present = np.nonzero(hist)[0]
+    bounds = np.concatenate(([0], np.cumsum(hist)))
+    group_start, group_end = bounds[present], bounds[present + 1]
+    prefix = np.concatenate(([0], np.cumsum(sorted_sums)))
+
+    # sorting key of a pixel: (value, neighbor sum) packed into one integer
+    key_scale = 256 * count + 1
+    keys = column[order] * key_scale + sorted_sums
+
+    def costs(lut_rows):
+        targets = lut_rows[:, present].astype(np.int64) * count  # gammas x values
+        split = np.searchsorted(keys, present * key_scale + targets)
+        below, above = split - group_start, group_end - split
+        return (targets * below - (prefix[split] - prefix[group_start])
+                + (prefix[group_end] - prefix[split]) - targets * above).sum(axis=1)
+    return costs
+
+def _search_exhaustive(evaluate, steps):
+    evaluate(np.arange(steps))
+
+def _search_coarse_to_fine(evaluate, steps, points=9):
+    """Evaluate points evenly spaced indices, then repeat on the interval around the best one."""
+    lo, hi = 0, steps - 1
+    while True:
+        evaluate(np.unique(np.linspace(lo, hi, points).round().astype(int)))
+        spacing = int(np.ceil((hi - lo) / (points - 1)))
+        if spacing <= 1:
+            return
+        best = evaluate.best()
+        lo, hi = max(0, best - spacing), min(steps - 1, best + spacing)
+
+def _search_golden(evaluate, steps):
+    """Golden-section search over the indices, assumes the cost is unimodal in gamma.
+
+    The surviving interior point is reused, so each step evaluates one new index; the last five
+    or fewer indices are evaluated exhaustively, where the two points could not be distinct.
+    """
+    lo, hi = 0, steps - 1
+    a = b = None
+    while hi - lo > 4:
+        if a is None or not lo < a < b < hi:
+            offset = int(round((hi - lo) * 0.381966))  # 1 - 1/golden ratio
+            a, b = lo + offset, hi - offset
+        cost_a, cost_b = evaluate(np.array([a, b]))
+        if cost_a <= cost_b:
+            hi, b = b, a
+            a = lo + hi - b
+        else:
+            lo, a = a, b
+            b = lo + hi - a
+        a, b = min(a, b), max(a, b)
+    evaluate(np.arange(lo, hi + 1))
+
+# gamma search strategies: each evaluates costs of candidate gamma indices through evaluate
+SEARCH_STRATEGIES = {
+    'exhaustive': _search_exhaustive,
+    'coarse_to_fine': _search_coarse_to_fine,
+    'golden': _search_golden,
+}
+
+def _memoized(cost_fn):
+    """Wraps cost_fn(indices) so every gamma index is evaluated at most once.
+
+    evaluate.best() is the evaluated index with the lowest cost, the smallest index on ties like
+    the exhaustive sweep, and len(evaluate.costs) is the number of cost evaluations.
+    """
+    costs = {}
+
+    def evaluate(indices):
+        missing = [int(i) for i in indices if int(i) not in costs]
+        if missing:
+            costs.update(zip(missing, cost_fn(np.array(missing))))
+        return [costs[int(i)] for i in indices]
+    evaluate.costs = costs
+    evaluate.best = lambda: min(sorted(costs), key=costs.get)
+    return evaluate
+
+def _remove_column_noise_gamma_search(img_array, num_neighbors, gamma_range, steps, strategy, sequential=True,
+                                      lut=False, columns=None):
+    """Column by column search of the gamma index, see remove_column_noise_gamma.
+
+    With lut=True img_array is a uint8 image and costs come from its histograms (LUT engine),
+    otherwise they are computed from the corrected float32 columns (vectorized engine).
+    columns restricts the search to some column indices (use with sequential=False).
+
+    Returns:
+        tuple: corrected image, index of the chosen gamma per column (-1 where every cost is NaN,
+            i.e. all-black columns) and the number of cost evaluations per column.
+    """
+    gammas = np.linspace(*gamma_range, steps)
+    if lut:
+        img_array = img_array.astype(np.int64)
+        # the full table only pays off when every gamma is tried
+        table = gamma_lut(tuple(gamma_range), steps) if strategy == 'exhaustive' else None
+        values = np.arange(256, dtype=np.float32)
+    source = img_array if sequential else img_array.copy()
+    if not sequential and not lut:
+        neighbor_means = _neighbor_means(img_array, num_neighbors)
+    search = SEARCH_STRATEGIES[strategy]
+    width = img_array.shape[1]
+    chosen = np.full(width, -1)
+    evaluations = np.zeros(width, dtype=int)
+
+    for col_idx in (range(width) if columns is None else columns):
+        column = img_array[:, col_idx].copy()
+        max_val = column.max()
+        if max_val == 0:
+            # every cost is NaN in the reference, which then keeps gamma 1.0
+            if not lut:
+                img_array[:, col_idx] = gamma_correction(column, 1.0)
+            continue
+        left_idx = max(0, col_idx - num_neighbors)
+        right_idx = min(width - 1, col_idx + num_neighbors)
+
+        if lut:
+            if table is not None:
+                rows = functools.partial(lambda m, idx: table[idx, m], max_val)
+            else:
+                rows = functools.partial(lambda m, idx: gamma_candidates(values[:m + 1], gammas[idx]), max_val)
+            cost_fn = _histogram_cost_fn(column, source[:, left_idx:right_idx + 1].sum(axis=1),
+                                         right_idx - left_idx + 1)
+            evaluate = _memoized(lambda idx: cost_fn(rows(idx)))
+            search(evaluate, steps)
+            best = evaluate.best()
+            img_array[:, col_idx] = rows(np.array([best]))[0, column]
+        else:
+            if not sequential:
+                neighbor_col = neighbor_means[:, col_idx]
+            elif left_idx == right_idx:
+                neighbor_col = source[:, left_idx]
+            else:
+                neighbor_col = np.mean(source[:, left_idx:right_idx + 1], axis=1)
+            evaluate = _memoized(lambda idx: np.abs(gamma_candidates(column, gammas[idx]) - neighbor_col).sum(axis=1))
+            search(evaluate, steps)
+            best = evaluate.best()
+            img_array[:, col_idx] = gamma_candidates(column, gammas[[best]])[0]
+        chosen[col_idx] = best
+        evaluations[col_idx] = len(evaluate.costs)
+    return img_array, chosen, evaluations
+
+def remove_column_noise_gamma(img, num_neighbors =3,  gamma_range=(0.5, 2.0), steps=20, engine='vectorized',
+                              sequential=True, max_block_bytes=16 * 2**20, strategy='exhaustive'):
+    """PIL version of remove_column_noise_gamma_array."""
+    return Image.fromarray(remove_column_noise_gamma_array(np.asarray(img), num_neighbors, gamma_range, steps, engine,
+                                                           sequential, max_block_bytes, strategy))
+
+def remove_column_noise_gamma_array(img_array, num_neighbors=3, gamma_range=(0.5, 2.0), steps=20, engine='vectorized',
+                                    sequential=True, max_block_bytes=16 * 2**20, strategy='exhaustive'):
+    """Gamma-corrects every column to minimise its difference to the mean of its neighbors.
+
+    engine='reference' runs optimize_gamma_for_column column by column. engine='vectorized'
+    evaluates all candidate gammas of a column in one broadcast and gives the identical result.
+    With sequential=False the neighbor means are taken from the input image instead of the
+    partially corrected one, so all columns are independent and evaluated together in blocks
+    of at most max_block_bytes; this is faster but not identical to the reference.
+
+    engine='lut' is for 8-bit images (other images use the vectorized engine): corrections are
+    looked up in gamma_lut, cached across images, and candidate costs are evaluated from a
+    histogram of the column, so trying a gamma costs O(256) instead of O(height). Costs are
+    exact integers, so it can pick a different gamma than the reference where float32
+    rounding decides between (near-)equal costs.
+
+    strategy picks which of the steps gammas are tried (vectorized and lut engines only):
+    'exhaustive' tries all of them, 'coarse_to_fine' a coarse grid refined around its best
+    gamma and 'golden' a golden-section search. The last two need O(log(steps)) cost
+    evaluations per column, so a fine gamma grid (large steps) stays cheap, but they can miss
+    the best gamma when the cost has several local minima; see compare_strategies.
+    """
+    if strategy not in SEARCH_STRATEGIES:
+        raise ValueError(f'Unknown strategy {strategy}, use one of {", ".join(SEARCH_STRATEGIES)}')
+    if engine == 'reference' and strategy != 'exhaustive':
+        raise ValueError('The reference engine only supports the exhaustive strategy')
+
+    if engine == 'lut' and img_array.dtype == np.uint8:
+        img_array, _, _ = _remove_column_noise_gamma_search(img_array, num_neighbors, gamma_range, steps,
+                                                            strategy, sequential, lut=True)
+        return img_array.astype(np.uint8)
+
+    img_array = np.array(img_array, dtype=np.float32)
+
+    if engine == 'reference':
+        # Process each column independently
+        for col_idx in range(img_array.shape[1]):
+            img_array[:, col_idx] = optimize_gamma_for_column(img_array, col_idx, num_neighbors, gamma_range, steps)
+    elif engine in ('vectorized', 'lut'):
+        gammas = np.linspace(*gamma_range, steps)
+        if strategy != 'exhaustive':
+            img_array, _, _ = _remove_column_noise_gamma_search(img_array, num_neighbors, gamma_range, steps,
+                                                                strategy, sequential)
+        elif sequential:
+            img_array = _remove_column_noise_gamma_sequential(img_array, num_neighbors, gammas)
+        else:
+            img_array = _remove_column_noise_gamma_independent(img_array, num_neighbors, gammas, max_block_bytes)
+    else:
+        raise ValueError(f'Unknown engine {engine}, use "reference", "vectorized" or "lut"')
+
+    return img_array.astype(np.uint8)
+
+DEFAULT_CALIBRATION_DIR = 'calibration'
+
+def calibration_path(sensor, width, calibration_dir=DEFAULT_CALIBRATION_DIR):
+    """Column gamma profile of a sensor at an image width: <calibration_dir>/<sensor>_w<width>.json"""
+    return os.path.join(calibration_dir, f'{sensor}_w{width}.json')
+
+def calibrate_column_gamma(imgs, num_neighbors=3, gamma_range=(0.5, 2.0), steps=100):
+    """Learns the per-column gamma of a sensor from images of the same width.
+
+    Every column of every image gets the gamma optimize_gamma_for_column would pick against the
+    neighbor means of the input image (sequential=False, exhaustive search with the LUT engine);
+    the profile stores the per-column median gamma over the images and its median absolute
+    deviation, used by column_gamma_drift as the column's expected spread.
+
+    Returns:
+        dict: profile for save_column_gamma_profile/apply_column_gamma_profile.
+    """
+    gammas = np.linspace(*gamma_range, steps)
+    chosen = []
+    for img in imgs:
+        img_array = np.asarray(img)
+        if img_array.dtype != np.uint8 or img_array.ndim != 2:
+            raise ValueError('Column gamma calibration needs 8-bit grayscale images')
+        if chosen and img_array.shape[1] != chosen[0].shape[0]:
+            raise ValueError(f'All calibration images must have the same width, got {img_array.shape[1]} '
+                             f'and {chosen[0].shape[0]}')
+        _, indices, _ = _remove_column_noise_gamma_search(img_array, num_neighbors, gamma_range, steps,
+                                                          'exhaustive', sequential=False, lut=True)
+        chosen.append(np.where(indices >= 0, gammas[indices], np.nan))
+    if not chosen:
+        raise ValueError('No calibration images')
+
+    chosen = np.stack(chosen)  # images x width, NaN for all-black columns
+    valid = ~np.isnan(chosen).all(axis=0)
+    median = np.ones(chosen.shape[1])  # the reference keeps gamma 1.0 where it cannot decide
+    spread = np.zeros(chosen.shape[1])
+    median[valid] = np.nanmedian(chosen[:, valid], axis=0)
+    spread[valid] = np.nanmedian(np.abs(chosen[:, valid] - median[valid]), axis=0)
+    return {'width': chosen.shape[1], 'num_neighbors': num_neighbors, 'gamma_range': list(gamma_range),
+            'steps': steps, 'images': chosen.shape[0],
+            'gamma_indices': np.abs(median[:, None] - gammas).argmin(axis=1).tolist(), 'spread': spread.tolist(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+def calibrate_column_gamma_by_width(imgs, **kwargs):
+    """calibrate_column_gamma of every image width present: the images are grouped by width.
+
+    Returns:
+        dict: width -> profile (its 'images' entry is the number of images of that width).
+    """
+    groups = {}
+    for img in imgs:
+        groups.setdefault(np.asarray(img).shape[1], []).append(img)
+    return {width: calibrate_column_gamma(group, **kwargs) for width, group in sorted(groups.items())}
+
+def save_column_gamma_profile(profile, sensor, calibration_dir=DEFAULT_CALIBRATION_DIR):
+    os.makedirs(calibration_dir, exist_ok=True)
+    path = calibration_path(sensor, profile['width'], calibration_dir)
+    with open(path, 'w') as f:
+        json.dump(dict(profile, sensor=sensor), f)
+    return path
+
+def load_column_gamma_profile(sensor, width, calibration_dir=DEFAULT_CALIBRATION_DIR):
+    """Profile of sensor at width, or None if that sensor was not calibrated at this width."""
+    path = calibration_path(sensor, width, calibration_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def column_gamma_drift(img, profile, sample_columns=32, tolerance=0.1):
+    """Fraction of sampled columns whose optimal gamma left the profile.
+
+    sample_columns evenly spaced columns are re-optimized like in calibrate_column_gamma; a column
+    has drifted when its gamma differs from the profile by more than max(tolerance, 3 * spread).
+    """
+    img_array = np.asarray(img)
+    gammas = np.linspace(*profile['gamma_range'], profile['steps'])
+    columns = np.unique(np.linspace(0, img_array.shape[1] - 1, sample_columns).round().astype(int))
+    _, indices, _ = _remove_column_noise_gamma_search(img_array, profile['num_neighbors'],
+                                                      tuple(profile['gamma_range']), profile['steps'], 'exhaustive',
+                                                      sequential=False, lut=True, columns=columns)
+    indices = indices[columns]
+    columns, indices = columns[indices >= 0], indices[indices >= 0]
+    if len(columns) == 0:
+        return 0.
+    expected = gammas[np.asarray(profile['gamma_indices'])[columns]]
+    limit = np.maximum(tolerance, 3 * np.asarray(profile['spread'])[columns])
+    return float((np.abs(gammas[indices] - expected) > limit).mean())
+
+def apply_column_gamma_profile(img, profile, max_drift=0.25, sample_columns=32, tolerance=0.1):
+    """PIL version of apply_column_gamma_profile_array."""
+    return Image.fromarray(apply_column_gamma_profile_array(np.asarray(img), profile, max_drift, sample_columns,
+                                                            tolerance))
+
+def apply_column_gamma_profile_array(img_array, profile, max_drift=0.25, sample_columns=32, tolerance=0.1, dst=None):
+    """Corrects an 8-bit image with a calibrated per-column gamma profile.
+
+    The correction is one gather from gamma_lut: every pixel is looked up with the gamma of its
+    column and the column maximum. When more than max_drift of the sampled columns drifted from
+    the profile (see column_gamma_drift) the image is fully optimized with
+    remove_column_noise_gamma instead.
+    """
+    if img_array.dtype != np.uint8 or img_array.ndim != 2 or img_array.shape[1] != profile['width']:
+        raise ValueError(f"Profile needs 8-bit grayscale images of width {profile['width']}")
+
+    gamma_range = tuple(profile['gamma_range'])
+    drift = column_gamma_drift(img_array, profile, sample_columns, tolerance)
+    if drift > max_drift:
+        print(f'Column gamma drift on {drift:.0%} of the sampled columns, optimizing all columns')
+        return remove_column_noise_gamma_array(img_array, profile['num_neighbors'], gamma_range, profile['steps'],
+                                               engine='lut')
+
+    lut = gamma_lut(gamma_range, profile['steps'])
+    gamma_indices = np.asarray(profile['gamma_indices'])
+    if dst is None:
+        return lut[gamma_indices, img_array.max(axis=0), img_array]
+    dst[...] = lut[gamma_indices, img_array.max(axis=0), img_array]
+    return dst
+
+def compare_engines(img, steps=20, **kwargs):
+    """Times the engines of remove_column_noise_gamma against the reference loop on one image.
+
+    Returns a list of (name, seconds, number of pixels differing from the reference).
+    """
+    gamma_lut(tuple(kwargs.get('gamma_range', (0.5, 2.0))), steps)  # built once and cached, keep it out of the timing
+    start = time.perf_counter()
+    reference = np.array(remove_column_noise_gamma(img, steps=steps, engine='reference', **kwargs))
+    results = [('reference', time.perf_counter() - start, 0)]
+
+    for name, options in [('vectorized', dict(engine='vectorized')),
+                          ('vectorized independent', dict(engine='vectorized', sequential=False)),
+                          ('lut', dict(engine='lut')),
+                          ('lut independent', dict(engine='lut', sequential=False))]:
+        start = time.perf_counter()
+        output = np.array(remove_column_noise_gamma(img, steps=steps, **options, **kwargs))
+        results.append((name, time.perf_counter() - start, int((output != reference).sum())))
+    return results
+
+def unimodal_misses(strategy, steps):
+    """Optimum indices that a search strategy misses on strictly unimodal costs.
+
+    Every index, the edges included, is tried as the optimum of a V-shaped cost, asymmetric so that
+    no two indices tie.
+
+    Returns:
+        tuple: (missed optima, mean cost evaluations).
+    """
+    misses, evaluations = [], 0
+    for optimum in range(steps):
+        evaluate = _memoized(lambda indices: np.where(indices < optimum, 2. * (optimum - indices),
+                                                      3. * (indices - optimum)))
+        SEARCH_STRATEGIES[strategy](evaluate, steps)
+        evaluations += len(evaluate.costs)
+        if evaluate.best() != optimum:
+            misses.append(optimum)
+    return misses, evaluations / steps
+
+def compare_strategies(img, steps=100, engine='lut', num_neighbors=3, gamma_range=(0.5, 2.0)):
+    """Compares the gamma search strategies with the exhaustive sweep on one image.
+
+    Columns are corrected independently (sequential=False) so that every strategy sees the same
+    neighbor means and a different choice in one column does not propagate to the next ones.
+
+    Each strategy is also run on synthetic unimodal costs with the optimum at every index, including
+    the edges and next to them, see unimodal_misses.
+
+    Returns:
+        list: (strategy, seconds, mean cost evaluations per column, fraction of columns whose gamma
+            differs from the exhaustive one, largest gamma difference, optima missed on unimodal
+            costs) per strategy.
+    """
+    lut = engine == 'lut' and np.asarray(img).dtype == np.uint8
+    img_array = np.asarray(img) if lut else np.array(img, dtype=np.float32)
+    if lut:
+        gamma_lut(tuple(gamma_range), steps)  # keep building the table out of the timing
+    gammas = np.linspace(*gamma_range, steps)
+
+    results, exhaustive = [], None
+    for strategy in SEARCH_STRATEGIES:
+        start = time.perf_counter()
+        _, chosen, evaluations = _remove_column_noise_gamma_search(img_array.copy(), num_neighbors, gamma_range,
+                                                                   steps, strategy, sequential=False, lut=lut)
+        seconds = time.perf_counter() - start
+        if exhaustive is None:
+            exhaustive = chosen
+        valid = exhaustive >= 0
+        gamma_delta = np.abs(gammas[chosen[valid]] - gammas[exhaustive[valid]])
+        results.append((strategy, seconds, evaluations[valid].mean(), (gamma_delta > 0).mean(),
+                        gamma_delta.max(initial=0.), unimodal_misses(strategy, steps)[0]))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the remove_column_noise_gamma engines or search strategies on images')
+    parser.add_argument('imgs', nargs='+', type=str, help='Paths to images')
+    parser.add_argument('--steps', type=int, default=100, help='Number of candidate gammas')
+    parser.add_argument('--compare-strategies', action='store_true',
+                        help='Compare the gamma search strategies instead of the engines')
+    parser.add_argument('--engine', type=str, default='lut', help='Engine of --compare-strategies')
+    parser.add_argument('--normalize', type=str, default=None,
+                        help='Instead of comparing, write columnwise_normalization of the image to this '
+                             '.npy/.tif/raw file, processed out-of-core in strips of rows')
+    parser.add_argument('--window', type=int, default=50, help='Window of --normalize')
+    parser.add_argument('--strip-rows', type=int, default=256, help='Rows per strip of --normalize')
+    parser.add_argument('--shape', type=int, nargs=2, default=None, help='Height and width of a raw uint8 input')
+    args = parser.parse_args()
+
+    if args.normalize:
+        src = open_image_memmap(args.imgs[0], args.shape)
+        dst = create_image_memmap(args.normalize, src.shape)
+        start = time.perf_counter()
+        columnwise_normalization_strips(src, args.window, dst, args.strip_rows)
+        print(f'{args.imgs[0]} -> {args.normalize} in {time.perf_counter() - start:.3f}s')
+        raise SystemExit
+
+    for path in args.imgs:
+        image = Image.open(path).convert('L')
+        if args.compare_strategies:
+            results = compare_strategies(image, steps=args.steps, engine=args.engine)
+            for name, seconds, evaluations, differing, max_delta, misses in results:
+                print(f'{path} {name:16s} {seconds:8.3f}s  x{results[0][1] / seconds:6.1f}  '
+                      f'evaluations/column: {evaluations:6.1f}  differing columns: {differing:6.1%}  '
+                      f'max gamma difference: {max_delta:.3f}  unimodal optima missed: {misses or "none"}')
+            continue
+        results = compare_engines(image, steps=args.steps)
+        for name, seconds, mismatches in results:
+            print(f'{path} {name:24s} {seconds:8.3f}s  x{results[0][1] / seconds:6.1f}  '
+                  f'differing pixels: {mismatches}')
@@ -1,10 +1,17 @@
 import argparse
+import csv
 import math
 import os
+import queue
+import threading
+import time
 import tkinter as tk
+from collections import OrderedDict
 from tkinter import filedialog
 from PIL import Image, ImageTk
 
+from tile_pyramid import TileCache, TilePyramid
+
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--cell_w', type=int, default=512, help='Cell width')
@@ -12,15 +19,201 @@ def get_args():
     parser.add_argument('--cols', type=int, default=3, help='Number of columns')
     parser.add_argument('--imgs', nargs='+', type=str, help='Paths to img files')
     parser.add_argument('--names', nargs='+', type=str, help='Labels for img files')
+    parser.add_argument('--cache_mb', type=float, default=1024, help='Memory cap of the decoded images')
+    parser.add_argument('--frame_log', type=str, default=None, help='CSV file to log the time of every frame to')
+    parser.add_argument('--tiles', action='store_true',
+                        help='Read the images that have a tile pyramid (see tile_pyramid.py) tile by tile')
+    parser.add_argument('--tile_cache_mb', type=float, default=256, help='Memory cap of the decoded tiles')
 
     args = parser.parse_args()
 
     return args
 
+class LazyImageLoader:
+    """Decoded images by (name, index), loaded on first use and kept in an LRU cache.
+
+    Images are opened only when asked for and fully decoded, so no file handle stays open. The
+    least recently used images are dropped once the decoded size exceeds max_bytes (the images
+    asked for last are always kept). prefetch loads images on a background thread; a get of an
+    image that is being prefetched waits for it instead of loading it twice.
+
+    Level n of an image is the image halved n times, made from level n - 1 and cached the same
+    way, so zoomed-out views resize from a level close to the displayed size.
+    """
+
+    def __init__(self, paths, max_bytes=2 ** 30):
+        self.paths = paths
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._images = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._requests = queue.Queue()
+        threading.Thread(target=self._prefetch_loop, daemon=True).start()
+
+    @staticmethod
+    def nbytes(img):
+        return img.width * img.height * len(img.getbands())
+
+    def get(self, key, index, level=0):
+        item = (key, index, level)
+        with self._lock:
+            if item in self._images:
+                self._images.move_to_end(item)
+                return self._images[item]
+            loading = self._loading.get(item)
+            if loading is None:
+                loading = self._loading[item] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            loading.wait()
+            return self.get(key, index, level)
+
+        try:
+            if level == 0:
+                img = Image.open(self.paths[key][index])
+                img.load()
+            else:
+                img = self.get(key, index, level - 1)
+                try:
+                    img = img.reduce(2)
+                except ValueError:  # modes reduce does not support, e.g. P
+                    img = img.resize((max(1, img.width // 2), max(1, img.height // 2)), Image.NEAREST)
+        except BaseException:
+            with self._lock:
+                del self._loading[item]
+            loading.set()
+            raise
+        with self._lock:
+            del self._loading[item]
+            self._images[item] = img
+            self.size += self.nbytes(img)
+            while self.size > self.max_bytes and len(self._images) > 1:
+                _, dropped = self._images.popitem(last=False)
+                self.size -= self.nbytes(dropped)
+        loading.set()
+        return img
+
+    def __contains__(self, item):
+        with self._lock:
+            return item in self._images
+
+    def prefetch(self, items):
+        """Load the (name, index) items in the background; replaces the items of an earlier prefetch."""
+        # only the latest request matters once the user moved on
+        while True:
+            try:
+                self._requests.get_nowait()
+            except queue.Empty:
+                break
+        self._requests.put(list(items))
+
+    def _prefetch_loop(self):
+        while True:
+            items = self._requests.get()
+            for key, index in items:
+                if not self._requests.empty():
+                    break
+                if (key, index, 0) not in self:
+                    try:
+                        self.get(key, index)
+                    except Exception as e:
+                        print(f"Prefetch of {self.paths[key][index]} failed: {e}")
+
+class RenderWorker:
+    """Renders view states on a background thread, only ever the latest one.
+
+    request replaces the state waiting to be rendered (counting it as dropped), so a burst of
+    requests, e.g. from a held pan button, costs at most one render behind the latest state.
+    Finished frames are put on the frames queue for the Tk thread to collect.
+    """
+
+    def __init__(self, render):
+        self.render = render
+        self.frames = queue.Queue()
+        self._pending = None
+        self._dropped = 0
+        self._condition = threading.Condition()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def request(self, state):
+        with self._condition:
+            if self._pending is not None:
+                self._dropped += 1
+            self._pending = (state, time.perf_counter())
+            self._condition.notify()
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                (state, requested), self._pending = self._pending, None
+                dropped, self._dropped = self._dropped, 0
+            start = time.perf_counter()
+            try:
+                images, error = self.render(state), None
+            except Exception as e:
+                images, error = None, e
+            self.frames.put({'state': state, 'images': images, 'error': error, 'requested': requested,
+                             'render': time.perf_counter() - start, 'dropped': dropped})
+
+class FrameLog:
+    """Frame times of the viewer: render time, latency from request to display and display interval."""
+
+    fields = ['frame', 'index', 'zoom', 'left_shift', 'down_shift', 'render_ms', 'latency_ms', 'interval_ms',
+              'dropped']
+
+    def __init__(self, path=None):
+        self.rows = []
+        self._file = open(path, 'w', newline='') if path is not None else None
+        self._writer = csv.DictWriter(self._file, fieldnames=self.fields) if self._file is not None else None
+        if self._writer is not None:
+            self._writer.writeheader()
+        self._last_shown = None
+
+    def add(self, frame, shown):
+        index, zoom, left_shift, down_shift = frame['state']
+        row = {'frame': len(self.rows), 'index': index, 'zoom': round(zoom, 4), 'left_shift': left_shift,
+               'down_shift': down_shift, 'render_ms': round(frame['render'] * 1e3, 2),
+               'latency_ms': round((shown - frame['requested']) * 1e3, 2),
+               'interval_ms': round((shown - self._last_shown) * 1e3, 2) if self._last_shown is not None else '',
+               'dropped': frame['dropped']}
+        self._last_shown = shown
+        self.rows.append(row)
+        if self._writer is not None:
+            self._writer.writerow(row)
+            self._file.flush()
+
+    def close(self):
+        if self.rows:
+            latencies = sorted(row['latency_ms'] for row in self.rows)
+            print('{} frames, render {:.1f} ms, latency median {:.1f} ms, 95th percentile {:.1f} ms, '
+                  '{} requests dropped'.format(
+                      len(self.rows), sum(row['render_ms'] for row in self.rows) / len(self.rows),
+                      latencies[len(latencies) // 2], latencies[int(0.95 * (len(latencies) - 1))],
+                      sum(row['dropped'] for row in self.rows)))
+        if self._file is not None:
+            self._file.close()
+
 class ImageComparisonApp:
-    def __init__(self, root, image_dict, cell_width, cell_height, cols):
+    def __init__(self, root, image_dict, cell_width, cell_height, cols, cache_bytes=2 ** 30, frame_log=None,
+                 tile_cache_bytes=None):
+        """image_dict maps every label to the list of its image paths, compared index by index.
+
+        The panels are rendered by a RenderWorker; the Tk thread only requests view states and
+        shows finished frames, logged to a FrameLog (CSV at frame_log if given).
+
+        With tile_cache_bytes, images with an up to date tile pyramid are read tile by tile
+        through a TileCache of that size instead of being decoded whole.
+        """
         self.root = root
         self.image_dict = image_dict
+        self.loader = LazyImageLoader(image_dict, cache_bytes)
+        self.tile_cache = TileCache(tile_cache_bytes) if tile_cache_bytes is not None else None
+        self.pyramids = {}
         self.keys = list(image_dict.keys())
 
         values = list(image_dict.values())
@@ -81,6 +274,9 @@ class ImageComparisonApp:
         self.shift_right_button = self.create_repeatable_button(self.controls_frame, text=">", command=self.shift_right)
         self.shift_right_button.pack(side=tk.LEFT)
 
+        self.frame_log = FrameLog(frame_log)
+        self.renderer = RenderWorker(self.render)
+        self.poll_frames()
         self.update_images()
 
     def create_repeatable_button(self, parent, text, command):
@@ -103,19 +299,24 @@ class ImageComparisonApp:
             self.root.after(50, lambda: self.repeat_action(command))
 
     def update_images(self):
-        # Clear the previous images
-        for i, label in enumerate(self.labels):
-            label.image = None
+        self.renderer.request((self.current_index, self.zoom_factor, self.left_shift, self.down_shift))
 
-        # Get the current set of images
+    def render(self, state):
+        """The panel images of a view state (index, zoom factor, left shift, down shift); runs on the RenderWorker."""
+        index, zoom_factor, left_shift, down_shift = state
+
+        # Get the current set of images, tile pyramids where there are
         images = []
         for key in self.keys:
-            images.append(self.image_dict[key][self.current_index])
-
-        cols = self.cols
-
-        self.tk_images = []
-        for img in images:
+            pyramid = self.pyramid(key, index)
+            images.append(pyramid if pyramid is not None else self.loader.get(key, index))
+        # the image sets of Next and Previous, while the user looks at this one
+        neighbors = [(index + 1) % self.max_index, (index - 1) % self.max_index]
+        self.loader.prefetch([(key, index) for index in neighbors for key in self.keys
+                              if self.pyramid(key, index) is None])
+
+        cells = []
+        for key, img in zip(self.keys, images):
             cell_width = self.cell_width
             cell_height = self.cell_height
             aspect_ratio = img.width / img.height
@@ -127,17 +328,78 @@ class ImageComparisonApp:
                 new_width = cell_width
                 new_height = int(cell_width / aspect_ratio)
 
-            resized_img = img.resize((int(new_width * self.zoom_factor), int(new_height * self.zoom_factor)))
-            cropped_img = resized_img.crop((self.left_shift, self.down_shift, cell_width+self.left_shift, cell_height+self.down_shift))
+            cells.append(self.visible_region(key, index, img, int(new_width * zoom_factor),
+                                             int(new_height * zoom_factor), left_shift, down_shift))
+        return cells
+
+    def pyramid(self, key, index):
+        """The TilePyramid of an image, None without tile cache or an up to date pyramid."""
+        if self.tile_cache is None:
+            return None
+        if (key, index) not in self.pyramids:
+            self.pyramids[(key, index)] = TilePyramid.open(self.image_dict[key][index], self.tile_cache)
+        return self.pyramids[(key, index)]
+
+    def poll_frames(self):
+        """Show the newest finished frame, if any; reschedules itself on the Tk thread."""
+        frame = None
+        while True:
+            try:
+                frame = self.renderer.frames.get_nowait()
+            except queue.Empty:
+                break
+        if frame is not None:
+            if frame['error'] is not None:
+                print(f"Rendering failed: {frame['error']}")
+            else:
+                self.show(frame['images'])
+                self.frame_log.add(frame, time.perf_counter())
+        self.root.after(5, self.poll_frames)
 
-            tk_img = ImageTk.PhotoImage(cropped_img)
-            self.tk_images.append(tk_img)
+    def show(self, images):
+        cols = self.cols
+
+        # only the PhotoImage conversion of finished images happens on the Tk thread
+        self.tk_images = [ImageTk.PhotoImage(img) for img in images]
 
         for i, tk_img in enumerate(self.tk_images):
             self.labels[i].config(image=tk_img)
             self.labels[i].grid(row=i // cols, column=i % cols, padx=5, pady=5)
             self.labels[i].image = tk_img
 
+    def visible_region(self, key, index, img, zoomed_width, zoomed_height, left, top):
+        """The cell of img resized to the zoomed size and shifted, resizing only the visible source region.
+
+        Same as img.resize((zoomed_width, zoomed_height)).crop(cell box), but the source is the
+        smallest pyramid level still at least as large as the zoomed size and only the part of it
+        under the cell is resampled; the cell outside the image is black, as crop pads. img is
+        a PIL image or a TilePyramid, of which only the tiles under the cell are read.
+        """
+        cell_width, cell_height = self.cell_width, self.cell_height
+        # visible part of the zoomed image, in zoomed coordinates
+        x0, y0 = max(left, 0), max(top, 0)
+        x1, y1 = min(left + cell_width, zoomed_width), min(top + cell_height, zoomed_height)
+        if x1 <= x0 or y1 <= y0:
+            return Image.new(img.mode, (cell_width, cell_height))
+
+        downscale = min(img.width / max(zoomed_width, 1), img.height / max(zoomed_height, 1))
+        level = int(math.floor(math.log2(downscale))) if downscale >= 2 else 0
+        level = min(level, int(math.log2(min(img.width, img.height))))
+        if isinstance(img, TilePyramid):
+            level = min(level, img.levels - 1)
+            width, height = img.level_size(level)
+            fx, fy = width / zoomed_width, height / zoomed_height
+            region = img.resize(level, (x1 - x0, y1 - y0), (x0 * fx, y0 * fy, x1 * fx, y1 * fy))
+        else:
+            source = self.loader.get(key, index, level) if level else img
+            fx, fy = source.width / zoomed_width, source.height / zoomed_height
+            region = source.resize((x1 - x0, y1 - y0), box=(x0 * fx, y0 * fy, x1 * fx, y1 * fy))
+        if (x0, y0, x1, y1) == (left, top, left + cell_width, top + cell_height):
+            return region
+        cell = Image.new(region.mode, (cell_width, cell_height))
+        cell.paste(region, (x0 - left, y0 - top))
+        return cell
+
     def zoom_in(self):
         self.zoom_factor *= 1.2
         self.update_images()
@@ -183,15 +445,15 @@ if __name__ == "__main__":
 
     for i in range(min(len(args.imgs),len(args.names))):
         images = sorted(os.listdir(args.imgs[i]))
-        images_PIL = [
-            Image.open(os.path.join(args.imgs[i], image)) 
-            for image in images
-        ]
+        # opened lazily by ImageComparisonApp
+        image_paths = [os.path.join(args.imgs[i], image) for image in images]
 
-        print(f'Added to dictionary under {args.names[i]}: {",".join(images)}')
+        print(f'Added to dictionary under {args.names[i]}: {len(images)} images')
 
-        image_dict[args.names[i]] = images_PIL
+        image_dict[args.names[i]] = image_paths
 
     root = tk.Tk()
-    app = ImageComparisonApp(root, image_dict, args.cell_w, args.cell_h, args.cols)
-    root.mainloop()
\ No newline at end of file
+    app = ImageComparisonApp(root, image_dict, args.cell_w, args.cell_h, args.cols, int(args.cache_mb * 2 ** 20),
+                             args.frame_log, int(args.tile_cache_mb * 2 ** 20) if args.tiles else None)
+    root.mainloop()
+    app.frame_log.close()
\ No newline at end of file
@@ -1,41 +1,153 @@
 import argparse
+import multiprocessing
 import os
+import sys
+import traceback
 import PIL
 from PIL import Image
+import cv2
 
-from image_preprocessing import *
-from ColumnNormalization import columnwise_normalization, remove_column_noise_gamma
+from ColumnNormalization import (DEFAULT_CALIBRATION_DIR, calibrate_column_gamma_by_width, load_column_gamma_profile,
+                                 save_column_gamma_profile)
+from preprocessing_cache import StageCache, file_key, print_cache_stats, stage_key
+from preprocessing_pipeline import Pipeline
 
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--imgs', type=str, help='Path to input hr imgs file')
     parser.add_argument('--output', type=str, help='Path to output imgs file')
+    parser.add_argument('--sensor', type=str, default=None,
+                        help='Correct column gamma with the calibrated profile of this sensor')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='Learn the column gamma profile of --sensor from --imgs instead of preprocessing')
+    parser.add_argument('--calibration_dir', type=str, default=DEFAULT_CALIBRATION_DIR)
+    parser.add_argument('--timings', action='store_true', help='Print the time spent in every stage')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='Files handed to a worker at once, default: files / (4 * workers)')
+    parser.add_argument('--force', action='store_true', help='Also process files whose output is up to date')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Cache stage outputs here and only recompute stages after the last cached one')
+    parser.add_argument('--cache_size_gb', type=float, default=10., help='Size bound of the stage cache')
 
     args = parser.parse_args()
+    if args.calibrate and args.sensor is None:
+        parser.error('--calibrate requires --sensor')
 
     return args
 
-def image_preprocessing(img):
-    #img = denoise_fastN1MeansDenoising(9, 21)(img)
-    img = remove_column_noise_gamma(img, steps=100)
-    #img = contrast_clahe(clipLimit=1.5, tileGridSize=12)(img)
-    #img = edge_unsharpMask(threshold=3)(img)
-    #img = misc_normalise_img()(img)
+def preprocessing_stages(profile=None):
+    stages = [
+        #('denoise_fastN1MeansDenoising', {'templateWindowSize': 9, 'searchWindowSize': 21}),
+        ('apply_column_gamma_profile', {'profile': profile}) if profile is not None else
+        ('remove_column_noise_gamma', {'steps': 100, 'engine': 'lut'}),
+        #('contrast_clahe', {'clipLimit': 1.5, 'tileGridSize': 12}),
+        #('edge_unsharpMask', {'threshold': 3}),
+        #'misc_normalise_img',
+    ]
 
-    return img
+    return stages
+
+def image_preprocessing(img, profile=None):
+    return Pipeline(preprocessing_stages(profile))(img)
+
+# per-process state of process_file, set by init_worker
+_args = None
+_pipelines = {}
+_cache = None
+
+def init_worker(args, single_threaded=True):
+    global _args, _pipelines, _cache
+    _args, _pipelines = args, {}
+    if args.cache_dir is not None:
+        _cache = StageCache(args.cache_dir, int(args.cache_size_gb * 2 ** 30))
+    if single_threaded:
+        # the processes already use every core, avoid oversubscribing with OpenCV threads
+        cv2.setNumThreads(1)
+
+def get_pipeline(width):
+    # one pipeline per width: profiles are per width and buffers per shape
+    if width not in _pipelines:
+        profile = None
+        if _args.sensor is not None:
+            profile = load_column_gamma_profile(_args.sensor, width, _args.calibration_dir)
+            if profile is None:
+                print(f"No calibration of {_args.sensor} at width {width}, optimizing all columns")
+        _pipelines[width] = Pipeline(preprocessing_stages(profile))
+    return _pipelines[width]
+
+def is_up_to_date(path_to_image, path_to_save):
+    return (os.path.exists(path_to_save) and
+            os.path.getmtime(path_to_save) >= os.path.getmtime(path_to_image))
+
+def process_file(file):
+    """Preprocess one file; returns (file, status, message, stage timings, cache stats) and never raises."""
+    path_to_image = os.path.join(_args.imgs, file)
+    path_to_save = os.path.join(_args.output, file)
+    if not _args.force and is_up_to_date(path_to_image, path_to_save):
+        return file, 'skipped', 'up to date', {}, {}
+    try:
+        image = Image.open(path_to_image).convert('L')
+        key = stage_key(file_key(path_to_image), 'convert', 'L') if _cache is not None else None
+
+        pipeline = get_pipeline(image.width)
+        image = pipeline(image, _cache, key)
+
+        image.save(path_to_save)
+    except Exception as e:
+        message = ''.join(traceback.format_exception_only(type(e), e)).strip()
+        return file, 'error', message, {}, _cache.pop_stats() if _cache is not None else {}
+    return file, 'done', '', pipeline.last_timings, _cache.pop_stats() if _cache is not None else {}
 
 if __name__ == '__main__':
     args = get_args()
 
     hr_files = sorted(os.listdir(args.imgs))
 
-    for file in hr_files:
-        print("Processing: "+file)
+    if args.calibrate:
+        images = [Image.open(os.path.join(args.imgs, file)).convert('L') for file in hr_files]
+        # profiles are per width, a folder with several widths gets one profile each
+        profiles = calibrate_column_gamma_by_width(images, steps=100)
+        for width, profile in profiles.items():
+            print(f"Calibration profile of width {width} ({profile['images']} images) written to: "
+                  + save_column_gamma_profile(profile, args.sensor, args.calibration_dir))
+        raise SystemExit
 
-        path_to_image = os.path.join(args.imgs, file)
-        image = Image.open(path_to_image).convert('L')
+    if args.workers > 1:
+        chunksize = args.chunksize or max(1, len(hr_files) // (4 * args.workers))
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(args,))
+        results = pool.imap(process_file, hr_files, chunksize=chunksize)
+    else:
+        pool = None
+        init_worker(args, single_threaded=False)
+        results = map(process_file, hr_files)
+
+    # imap keeps the order of hr_files, so progress is printed in file order
+    timings, cache_stats, failed = {}, {}, []
+    for index, (file, status, message, file_timings, file_cache_stats) in enumerate(results, 1):
+        if status == 'error':
+            failed.append(file)
+            print(f"[{index}/{len(hr_files)}] Failed: {file}: {message}")
+        elif status == 'skipped':
+            print(f"[{index}/{len(hr_files)}] Skipped: {file} ({message})")
+        else:
+            print(f"[{index}/{len(hr_files)}] Processed: {file}")
+        for label, seconds in file_timings.items():
+            timings.setdefault(label, []).append(seconds)
+        for name, count in file_cache_stats.items():
+            cache_stats[name] = cache_stats.get(name, 0) + count
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if args.timings:
+        print("Stage timings:")
+        for label, times in timings.items():
+            print(f'{label:40s} {sum(times) / len(times) * 1e3:9.2f} ms/image {sum(times):9.2f} s total')
 
-        image = image_preprocessing(image)
+    if args.cache_dir is not None:
+        print_cache_stats(cache_stats)
 
-        path_to_save = os.path.join(args.output, file)
-        image.save(path_to_save)
\ No newline at end of file
+    if failed:
+        print(f"{len(failed)} of {len(hr_files)} files failed: " + ", ".join(failed))
+        sys.exit(1)
@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import traceback
+from types import SimpleNamespace
+import numpy as np
+from PIL import Image, ImageFilter
+import cv2
+
+import image_preprocessing as ip
+from ColumnNormalization import SEARCH_STRATEGIES, unimodal_misses
+import PreprocessSweep
+from RotateImage import largest_inscribed_box, rotate_crop_array, rotated_canvas_size
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Check that the image_preprocessing factories give the same '
+                                                 'output as their original PIL/OpenCV implementations, that '
+                                                 'PreprocessSweep grids pass list parameters through, that the gamma '
+                                                 'searches find every optimum of unimodal costs, and that '
+                                                 'RotateImage crops match PIL rotate(expand=True).')
+    parser.add_argument('--imgs', nargs='+', type=str,
+                        default=['testsets/Set12/01.png', 'testsets/Set12/05.png', 'testsets/Set5/HR/baby.png',
+                                 'testsets/Set5/HR/butterfly.png'],
+                        help='Paths to images, grayscale and RGB')
+
+    args = parser.parse_args()
+
+    return args
+
+# the factories as they were before the ndarray cores, as references
+def _reference_cv2(func):
+    return lambda img: Image.fromarray(func(np.array(img)))
+
+def _reference_erosion(kernel_size=3, iterations=1):
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+    return _reference_cv2(lambda img_np: cv2.erode(img_np, kernel, iterations=iterations))
+
+def _reference_binary_erosion(kernel_size=5, iterations=1):
+    def processing(img_np):
+        _, binary_image = cv2.threshold(img_np, 127, 255, cv2.THRESH_BINARY)
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+        eroded_image = cv2.erode(binary_image, kernel, iterations=iterations)
+        return cv2.convertScaleAbs(cv2.subtract(binary_image, eroded_image))
+    return _reference_cv2(processing)
+
+def _reference_gradient(operator, **kwargs):
+    def processing(img_np):
+        x = cv2.convertScaleAbs(operator(img_np, cv2.CV_64F, 1, 0, **kwargs))
+        y = cv2.convertScaleAbs(operator(img_np, cv2.CV_64F, 0, 1, **kwargs))
+        return cv2.addWeighted(x, 0.5, y, 0.5, 0)
+    return _reference_cv2(processing)
+
+def _reference_gamma(gamma=0.8):
+    lut = [int((i / 255.0) ** gamma * 255) for i in range(256)]
+    return lambda img: img.point(lut)
+
+def _reference_normalise(target_min=0, target_max=255):
+    def processing(img):
+        img_np = np.array(img).astype(np.float32)
+        img_min, img_max = np.min(img_np), np.max(img_np)
+        if img_max == img_min:
+            return np.full_like(img_np, target_min, dtype=np.float32)
+        normalized_image = target_min + (img_np - img_min) * (target_max - target_min) / (img_max - img_min)
+        return Image.fromarray(normalized_image.astype(np.uint8))
+    return processing
+
+# name: (current factory, reference factory)
+CHECKS = {
+    'denoise_gaussianBlur': (ip.denoise_gaussianBlur(), lambda img: img.filter(ImageFilter.GaussianBlur(radius=2))),
+    'denoise_fastN1MeansDenoising': (ip.denoise_fastN1MeansDenoising(), _reference_cv2(
+        lambda img_np: cv2.fastNlMeansDenoising(img_np, None, h=10, templateWindowSize=7, searchWindowSize=21))),
+    'denoise_medianBlur': (ip.denoise_medianBlur(), _reference_cv2(lambda img_np: cv2.medianBlur(img_np, 3))),
+    'denoise_bilateralFilter': (ip.denoise_bilateralFilter(), _reference_cv2(
+        lambda img_np: cv2.bilateralFilter(img_np, d=9, sigmaColor=75, sigmaSpace=75))),
+    'edge_unsharpMask': (ip.edge_unsharpMask(), lambda img: img.filter(ImageFilter.UnsharpMask(2, 150, 3))),
+    'edge_grayscale_erosion': (ip.edge_grayscale_erosion(), _reference_erosion()),
+    'edge_mask_laplacian': (ip.edge_mask_laplacian(), _reference_cv2(
+        lambda img_np: cv2.convertScaleAbs(cv2.Laplacian(img_np, cv2.CV_64F)))),
+    'edge_mask_binary_erosion': (ip.edge_mask_binary_erosion(), _reference_binary_erosion()),
+    'edge_mask_sobel_filter': (ip.edge_mask_sobel_filter(), _reference_gradient(cv2.Sobel, ksize=3)),
+    'edge_mask_scharr_filter': (ip.edge_mask_scharr_filter(), _reference_gradient(cv2.Scharr)),
+    'contrast_clahe': (ip.contrast_clahe(), _reference_cv2(
+        lambda img_np: cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(img_np))),
+    'contrast_gamma_correction': (ip.contrast_gamma_correction(), _reference_gamma()),
+    'misc_convert_binary': (ip.misc_convert_binary(), _reference_cv2(
+        lambda img_np: cv2.threshold(img_np, 50, 255, cv2.THRESH_BINARY)[1])),
+    'misc_normalise_img': (ip.misc_normalise_img(), _reference_normalise()),
+}
+
+def _run(factory, img):
+    try:
+        return np.asarray(factory(img)), None
+    except Exception as e:
+        return None, ''.join(traceback.format_exception_only(type(e), e)).strip()
+
+def check(img, name):
+    """'ok', 'skipped (...)' when the reference fails too, or a description of the difference."""
+    current, reference = CHECKS[name]
+    expected, reference_error = _run(reference, img)
+    output, error = _run(current, img)
+    if reference_error is not None:
+        return f'skipped (reference fails: {reference_error})' if error is not None else 'ok (reference fails)'
+    if error is not None:
+        return f'FAILED: {error}'
+    if output.shape != expected.shape:
+        return f'FAILED: shape {output.shape} instead of {expected.shape}'
+    if not np.array_equal(output, expected):
+        diff = np.abs(output.astype(int) - expected.astype(int))
+        return f'FAILED: max difference {diff.max()} on {np.mean(diff > 0):.2%} of the values'
+    return 'ok'
+
+# a list parameter (gamma_range) next to a swept one (clipLimit)
+SWEEP_GRID = {'grid': [
+    [None, ['remove_column_noise_gamma', {'steps': 20, 'engine': 'lut', 'gamma_range': [0.5, 2.0]}]],
+    [['contrast_clahe', {'clipLimit': {'sweep': [1.5, 2.0]}}]],
+]}
+
+def check_sweep(path):
+    """'ok' or a description of the problem of PreprocessSweep on SWEEP_GRID and one grayscale image."""
+    with tempfile.TemporaryDirectory() as folder:
+        with open(os.path.join(folder, 'grid.json'), 'w') as f:
+            json.dump(SWEEP_GRID, f)
+        configs = PreprocessSweep.load_configs(os.path.join(folder, 'grid.json'))
+        if len(configs) != 4:
+            return f'FAILED: {len(configs)} configurations instead of 4'
+        for name, stages in configs:
+            for stage_name, params in stages:
+                if stage_name == 'remove_column_noise_gamma' and params['gamma_range'] != [0.5, 2.0]:
+                    return f"FAILED: {name} has gamma_range {params['gamma_range']}"
+        for name, _ in configs:
+            os.makedirs(os.path.join(folder, name))
+        PreprocessSweep.init_worker(SimpleNamespace(imgs=os.path.dirname(path), output=folder),
+                                    PreprocessSweep.build_trie(configs), single_threaded=False)
+        _, error, _, config_stats, config_errors = PreprocessSweep.process_file(os.path.basename(path))
+    if error is not None or config_errors:
+        return f'FAILED: {error or config_errors}'
+    if len(config_stats) != 4:
+        return f'FAILED: outputs of {sorted(config_stats)} only'
+    return 'ok'
+
+# small step counts reach the exhaustive tail of the golden search right away
+SEARCH_STEPS = [2, 5, 6, 7, 13, 20, 100]
+
+def check_search(strategy):
+    """'ok' or the optima a gamma search strategy misses on unimodal costs, edges included."""
+    for steps in SEARCH_STEPS:
+        misses, _ = unimodal_misses(strategy, steps)
+        if misses:
+            return f'FAILED: steps={steps} misses the optima {misses}'
+    return 'ok'
+
+# odd, mixed and even sizes; 90 degrees is a transpose in PIL
+ROTATION_SIZES = [(257, 257), (257, 301), (300, 301), (256, 256), (3, 7)]
+ROTATION_ANGLES = [0, 0.3, 3, 10, 45, -7.2, 90, 180, 270]
+
+def check_rotation():
+    """'ok' or a description of where RotateImage disagrees with PIL rotate(expand=True) on random images."""
+    rng = np.random.default_rng(0)
+    for width, height in ROTATION_SIZES:
+        for angle in ROTATION_ANGLES:
+            expected = Image.new('L', (width, height)).rotate(angle, expand=True).size
+            if rotated_canvas_size(width, height, angle) != expected:
+                return f'FAILED: canvas of {width}x{height} at {angle} deg is ' \
+                       f'{rotated_canvas_size(width, height, angle)} instead of {expected}'
+        crop = rng.integers(0, 256, (height, width), dtype=np.uint8)
+        if not np.array_equal(rotate_crop_array(crop, 0, (0, 0, width, height)), crop):
+            return f'FAILED: {width}x{height} is not unchanged by a 0 deg rotate-crop'
+        for angle in ROTATION_ANGLES:
+            # inside the inscribed box PIL bilinear and cv2 linear only differ by rounding
+            left, top, right, bottom = largest_inscribed_box(width, height, angle)
+            canvas = np.asarray(Image.fromarray(crop).rotate(angle, expand=True, resample=Image.BILINEAR))
+            diff = np.abs(rotate_crop_array(crop, angle).astype(int) - canvas[top:bottom, left:right].astype(int))
+            if diff.max() > 1:
+                return f'FAILED: {width}x{height} at {angle} deg differs from PIL by up to {diff.max()}'
+    return 'ok'
+
+if __name__ == '__main__':
+    args = get_args()
+
+    failed = 0
+    for path in args.imgs:
+        img = Image.open(path)
+        # the factories take grayscale or RGB images
+        img = img.convert('RGB' if len(img.getbands()) >= 3 else 'L')
+        for name in CHECKS:
+            result = check(img, name)
+            failed += result.startswith('FAILED')
+            print(f'{path} ({img.mode}) {name:30s} {result}')
+
+    result = check_sweep(args.imgs[0])
+    failed += result.startswith('FAILED')
+    print(f'PreprocessSweep grid with a list parameter: {result}')
+
+    for strategy in SEARCH_STRATEGIES:
+        result = check_search(strategy)
+        failed += result.startswith('FAILED')
+        print(f'ColumnNormalization {strategy} search on unimodal costs: {result}')
+
+    result = check_rotation()
+    failed += result.startswith('FAILED')
+    print(f'RotateImage canvas and crops against PIL: {result}')
+
+    if failed:
+        print(f'{failed} checks failed')
+        sys.exit(1)
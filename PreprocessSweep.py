@@ -0,0 +1,235 @@
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+import numpy as np
+from PIL import Image
+import cv2
+
+from preprocessing_pipeline import STAGES
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Run a grid of preprocessing pipelines over a folder, computing '
+                                                 'every shared prefix of stages once per image.')
+    parser.add_argument('--imgs', type=str, help='Path to input hr imgs file')
+    parser.add_argument('--output', type=str, help='Output folder, one subfolder per configuration')
+    parser.add_argument('--grid', type=str, help='JSON file with the configurations, see load_configs')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+
+    args = parser.parse_args()
+
+    return args
+
+def normalize_stage(stage):
+    """(name, params) of a stage given as "name" or [name, params]."""
+    name, params = (stage, {}) if isinstance(stage, str) else stage
+    if name not in STAGES:
+        raise ValueError(f'Unknown preprocessing stage {name}, use one of {", ".join(STAGES)}')
+    return name, dict(params)
+
+def is_sweep(value):
+    return isinstance(value, dict) and set(value) == {'sweep'}
+
+def expand_params(name, params):
+    """Every combination of the swept parameters of a stage, given as {"sweep": [value, ...]}.
+
+    Other values, lists included (e.g. gamma_range: [0.5, 2.0]), are passed to the stage as they are.
+    """
+    keys = [k for k, v in params.items() if is_sweep(v)]
+    for values in itertools.product(*(params[k]['sweep'] for k in keys)):
+        yield name, dict(params, **dict(zip(keys, values)))
+
+def load_configs(path):
+    """Configurations of a grid file: list of (name, [(stage name, params), ...]).
+
+    The file holds explicit configurations, {"configs": {"name": [stage, ...], ...}}, and/or a
+    grid, {"grid": [slot, ...]}, where every slot is a list of alternatives: a stage ("name" or
+    [name, params]) or null to skip the slot. Swept parameters of a grid stage are expanded too,
+    e.g. ["contrast_clahe", {"clipLimit": {"sweep": [1.5, 2.0]}}] gives two alternatives.
+    The grid yields one configuration per combination of alternatives.
+    """
+    with open(path) as f:
+        spec = json.load(f)
+
+    configs = []
+    for name, stages in spec.get('configs', {}).items():
+        stages = [normalize_stage(stage) for stage in stages]
+        if any(is_sweep(value) for _, params in stages for value in params.values()):
+            raise ValueError(f'Configuration {name} of {path} sweeps a parameter, only the grid can')
+        configs.append((name, stages))
+    slots = []
+    for slot in spec.get('grid', []):
+        alternatives = []
+        for stage in slot:
+            alternatives.extend([None] if stage is None else expand_params(*normalize_stage(stage)))
+        slots.append(alternatives)
+    if slots:
+        for index, combination in enumerate(itertools.product(*slots)):
+            configs.append((f'grid{index:03d}', [stage for stage in combination if stage is not None]))
+    if not configs:
+        raise ValueError(f'{path} defines no configurations')
+    return configs
+
+def stage_label(stage):
+    name, params = stage
+    return name + ('(' + ', '.join(f'{k}={v}' for k, v in sorted(params.items())) + ')' if params else '')
+
+def build_trie(configs):
+    """Prefix tree of the configurations.
+
+    A node is {'stage': (name, params), 'children': {label: node}, 'configs': [names ending here]};
+    configurations with a common prefix of stages share the nodes of that prefix.
+    """
+    root = {'stage': None, 'children': {}, 'configs': []}
+    for name, stages in configs:
+        node = root
+        for stage in stages:
+            node = node['children'].setdefault(stage_label(stage), {'stage': stage, 'children': {}, 'configs': []})
+        node['configs'].append(name)
+    return root
+
+def count_nodes(node):
+    return sum(1 + count_nodes(child) for child in node['children'].values())
+
+def output_stats(img_np):
+    """Summary values of an output: mean, std and column striping (mean |difference| of adjacent column means)."""
+    col_means = img_np.mean(axis=0)
+    return {'mean': float(img_np.mean()), 'std': float(img_np.std()),
+            'column_stripe': float(np.abs(np.diff(col_means)).mean()) if len(col_means) > 1 else 0.}
+
+# per-process state of process_file, set by init_worker
+_args = None
+_trie = None
+
+def init_worker(args, trie, single_threaded=True):
+    global _args, _trie
+    _args, _trie = args, trie
+    if single_threaded:
+        # the processes already use every core, avoid oversubscribing with OpenCV threads
+        cv2.setNumThreads(1)
+
+def subtree_configs(node):
+    return node['configs'] + [config for child in node['children'].values() for config in subtree_configs(child)]
+
+def process_file(file):
+    """Run the whole trie on one image depth first; returns (file, error, node times, config stats, config errors).
+
+    A stage that fails fails the configurations below its node only, the other branches still run.
+    """
+    node_times, config_stats, config_errors = {}, {}, {}
+
+    def visit(node, img_np, path):
+        for label, child in node['children'].items():
+            name, params = child['stage']
+            child_path = path + (label,)
+            try:
+                start = time.perf_counter()
+                output = STAGES[name](img_np, **params)
+                node_times[child_path] = time.perf_counter() - start
+                for config in child['configs']:
+                    Image.fromarray(output).save(os.path.join(_args.output, config, file))
+                    config_stats[config] = output_stats(output)
+            except Exception as e:
+                error = f"{label}: {''.join(traceback.format_exception_only(type(e), e)).strip()}"
+                for config in subtree_configs(child):
+                    config_errors.setdefault(config, error)
+                    config_stats.pop(config, None)
+                continue
+            visit(child, output, child_path)
+
+    try:
+        image = np.asarray(Image.open(os.path.join(_args.imgs, file)).convert('L'))
+        for config in _trie['configs']:
+            # empty configuration: the unprocessed image
+            Image.fromarray(image).save(os.path.join(_args.output, config, file))
+            config_stats[config] = output_stats(image)
+    except Exception as e:
+        return file, ''.join(traceback.format_exception_only(type(e), e)).strip(), node_times, config_stats, {}
+    visit(_trie, image, ())
+    return file, None, node_times, config_stats, config_errors
+
+def standalone_seconds(stages, node_times):
+    """Mean time per image of a configuration run on its own: the sum of its stage times."""
+    labels = [stage_label(stage) for stage in stages]
+    prefixes = [tuple(labels[:i + 1]) for i in range(len(labels))]
+    return sum(np.mean(node_times[prefix]) for prefix in prefixes if prefix in node_times)
+
+def write_summary(path, configs, node_times, config_stats, config_failures=None):
+    """CSV with one row per configuration: stages, images, failed images, standalone time and mean output stats.
+
+    standalone_ms is the time the configuration would take on its own (sum of its stage times).
+    """
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['config', 'stages', 'images', 'failed', 'standalone_ms', 'mean', 'std', 'column_stripe'])
+        for name, stages in configs:
+            stats = config_stats.get(name, [])
+            row = [name, ' -> '.join(stage_label(stage) for stage in stages) or '(none)', len(stats),
+                   len((config_failures or {}).get(name, [])), f'{standalone_seconds(stages, node_times) * 1e3:.2f}']
+            row += [f"{np.mean([s[k] for s in stats]):.4f}" if stats else '' for k in ('mean', 'std', 'column_stripe')]
+            writer.writerow(row)
+
+if __name__ == '__main__':
+    args = get_args()
+
+    configs = load_configs(args.grid)
+    names = [name for name, _ in configs]
+    if len(set(names)) != len(names):
+        raise SystemExit(f'Duplicate configuration names in {args.grid}')
+    trie = build_trie(configs)
+    naive = sum(len(stages) for _, stages in configs)
+    print(f"{len(configs)} configurations, {count_nodes(trie)} unique stage prefixes per image "
+          f"instead of {naive}")
+
+    for name in names:
+        os.makedirs(os.path.join(args.output, name), exist_ok=True)
+    hr_files = sorted(os.listdir(args.imgs))
+
+    if args.workers > 1:
+        chunksize = max(1, len(hr_files) // (4 * args.workers))
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(args, trie))
+        results = pool.imap(process_file, hr_files, chunksize=chunksize)
+    else:
+        pool = None
+        init_worker(args, trie, single_threaded=False)
+        results = map(process_file, hr_files)
+
+    start = time.perf_counter()
+    node_times, config_stats, config_failures, failed = {}, {}, {}, []
+    for index, (file, error, file_node_times, file_config_stats, file_config_errors) in enumerate(results, 1):
+        if error is not None:
+            failed.append(file)
+            print(f"[{index}/{len(hr_files)}] Failed: {file}: {error}")
+            continue
+        print(f"[{index}/{len(hr_files)}] Processed: {file}"
+              + (f" ({len(file_config_errors)} configurations failed)" if file_config_errors else ""))
+        for name, config_error in file_config_errors.items():
+            config_failures.setdefault(name, []).append((file, config_error))
+        for path, seconds in file_node_times.items():
+            node_times.setdefault(path, []).append(seconds)
+        for name, stats in file_config_stats.items():
+            config_stats.setdefault(name, []).append(stats)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    summary = os.path.join(args.output, 'summary.csv')
+    write_summary(summary, configs, node_times, config_stats, config_failures)
+    computed = sum(sum(times) for times in node_times.values())
+    standalone = sum(standalone_seconds(stages, node_times) for _, stages in configs) * (len(hr_files) - len(failed))
+    print(f"Stage compute {computed:.2f}s (running every configuration separately: ~{standalone:.2f}s), "
+          f"wall {time.perf_counter() - start:.2f}s")
+    print(f"Summary written to: {summary}")
+
+    for name, failures in config_failures.items():
+        file, config_error = failures[0]
+        print(f"Configuration {name} failed on {len(failures)} files, e.g. {file}: {config_error}")
+    if failed:
+        print(f"{len(failed)} of {len(hr_files)} files failed: " + ", ".join(failed))
+    if failed or config_failures:
+        sys.exit(1)
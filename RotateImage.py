@@ -1,7 +1,19 @@
+import argparse
+import csv
+import json
+import math
+import multiprocessing
+import os
+import re
+import sys
+import time
+import traceback
 import cv2
 import numpy as np
 from PIL import Image
 
+from preprocessing_cache import file_key
+
 def detect_rotation_angle(img, edge_thresholds=(50, 150), hough_threshold=100):
     """Detects the rotation angle of an image based on its black edge using Hough Transform."""
     # Load image in grayscale
@@ -31,11 +43,453 @@ def detect_rotation_angle(img, edge_thresholds=(50, 150), hough_threshold=100):
     rotation_angle = np.median(angles)  # Using median for robustness
     return rotation_angle
 
-def rotate_image(img):
-    """Rotates an image based on the detected rotation angle and saves the corrected image."""
-    angle = detect_rotation_angle(img)
-    print(f"Detected Rotation Angle: {angle:.2f} degrees")
-    
-    # Rotate and save
-    rotated_image = img.rotate(-angle, expand=True, fillcolor=(0, 0, 0))
-    return rotated_image
\ No newline at end of file
+def _hough_lines(edges, theta_step, hough_threshold, min_angle, max_angle):
+    """rho, angle (degrees, as in detect_rotation_angle) and votes of the lines between min_angle and max_angle."""
+    min_theta, max_theta = np.radians(90 + min_angle), np.radians(90 + max_angle)
+    if hasattr(cv2, 'HoughLinesWithAccumulator'):
+        lines = cv2.HoughLinesWithAccumulator(edges, 1, np.radians(theta_step), hough_threshold,
+                                              min_theta=min_theta, max_theta=max_theta)
+    else:
+        lines = cv2.HoughLines(edges, 1, np.radians(theta_step), hough_threshold,
+                               min_theta=min_theta, max_theta=max_theta)
+    if lines is None:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    lines = lines.reshape(-1, lines.shape[-1])  # (N, 1, 2|3), or (N, 3) from some OpenCV versions
+    votes = lines[:, 2] if lines.shape[1] > 2 else np.ones(len(lines))
+    return lines[:, 0], np.degrees(lines[:, 1]) - 90, votes
+
+def _border_edges(image, rhos, angles, scale, band, edge_thresholds):
+    """Canny edges of image, only within band pixels of lines found on the image downscaled by scale.
+
+    The lines are within 45 degrees of horizontal, so each band lies in a strip of rows; Canny
+    only runs on those strips (with a small margin for its own neighborhood).
+    """
+    height, width = image.shape[:2]
+    mask = np.zeros((height, width), dtype=np.uint8)
+    strips = []
+    for rho, theta in zip(rhos / scale, np.radians(angles + 90)):
+        # x cos(theta) + y sin(theta) = rho, sin(theta) >= sin(45 degrees)
+        y_left, y_right = rho / np.sin(theta), (rho - width * np.cos(theta)) / np.sin(theta)
+        cv2.line(mask, (0, int(round(y_left))), (width, int(round(y_right))), 255, 2 * band + 1)
+        strips.append((max(0, int(min(y_left, y_right)) - band - 4), min(height, int(max(y_left, y_right)) + band + 5)))
+
+    edges = np.zeros_like(mask)
+    merged = []
+    for top, bottom in sorted(strips):
+        if merged and top <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], bottom)
+        elif bottom > top:
+            merged.append([top, bottom])
+    for top, bottom in merged:
+        edges[top:bottom] = cv2.Canny(np.ascontiguousarray(image[top:bottom]), edge_thresholds[0], edge_thresholds[1])
+    return edges & mask
+
+def detect_rotation_angle_pyramid(img, edge_thresholds=(50, 150), hough_threshold=100, coarse_size=512,
+                                  coarse_step=0.5, precision=0.02, min_votes_ratio=0.5):
+    """Coarse-to-fine version of detect_rotation_angle.
+
+    The angle is first searched over (-45, 45) degrees with coarse_step on the image
+    downscaled by a power of two to at most coarse_size (longest side); the strongest line,
+    normally a border edge, gives the coarse angle. It is then refined at full resolution with
+    steps of precision degrees, within two coarse steps of the coarse angle and only on the
+    edges close to the strong coarse lines that agree with it (the borders), so full-resolution
+    Canny and Hough only see a few strips of the image. The refined angle is the vote-weighted
+    median of the strong fine lines.
+
+    Lines with at least min_votes_ratio of the maximum votes count as strong.
+
+    Returns:
+        tuple: (angle in degrees, confidence in [0, 1]). The confidence is the product, over
+            both levels, of the vote share of the strong lines that agree with the estimate
+            (within two steps); (0, 0) when no line was detected.
+    """
+    image = np.asarray(img)
+    factor = 2 ** max(0, int(np.ceil(np.log2(max(image.shape[:2]) / coarse_size))))
+    scale = 1. / factor
+
+    # coarse: downscaled image, the whole angle range; line votes shrink with the image
+    small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if factor > 1 else image
+    edges = cv2.Canny(small, edge_thresholds[0], edge_thresholds[1])
+    # (-45, 45) exclusive like detect_rotation_angle: diagonal texture piles up at the limits
+    rhos, angles, votes = _hough_lines(edges, coarse_step, max(1, int(hough_threshold * scale)),
+                                       -45 + coarse_step, 45 - coarse_step)
+    if len(angles) == 0:
+        return 0., 0.
+    strong = votes >= min_votes_ratio * votes.max()
+    coarse = angles[np.argmax(votes)]
+    agree = strong & (np.abs(angles - coarse) <= 2 * coarse_step)
+    confidence = votes[agree].sum() / votes[strong].sum()
+
+    # fine: full resolution around the agreeing lines; the coarse angle can be off by a step,
+    # which moves the line ends by up to max(shape) * sin(coarse_step)
+    band = int(np.ceil(max(image.shape[:2]) * np.sin(np.radians(coarse_step)) + 2 / scale))
+    edges = _border_edges(image, rhos[agree], angles[agree], scale, band, edge_thresholds)
+    _, angles, votes = _hough_lines(edges, precision, hough_threshold, coarse - 2 * coarse_step,
+                                    coarse + 2 * coarse_step)
+    if len(angles) == 0:
+        return float(coarse), float(confidence)
+    strong = votes >= min_votes_ratio * votes.max()
+    order = np.argsort(angles[strong])
+    cumulative = np.cumsum(votes[strong][order])
+    angle = angles[strong][order][np.searchsorted(cumulative, cumulative[-1] / 2)]
+    confidence *= votes[strong & (np.abs(angles - angle) <= 2 * precision)].sum() / votes[strong].sum()
+    return float(angle), float(confidence)
+
+def synthetic_rotation(img, angle, upscale=4):
+    """A test scan: img upscaled and tilted on a black canvas so that detect_rotation_angle should return angle.
+
+    (detect_rotation_angle measures the tilt clockwise, PIL rotates counter-clockwise.)
+    """
+    img = img.convert('L')
+    img = img.resize((img.width * upscale, img.height * upscale), Image.BICUBIC)
+    return img.rotate(-angle, resample=Image.BICUBIC, expand=True, fillcolor=0)
+
+def benchmark_rotation_detection(imgs, angles=(-7.3, -2.25, -0.8, -0.35, 0.15, 0.6, 1.4, 4.75), upscale=4):
+    """Time and error of detect_rotation_angle and detect_rotation_angle_pyramid on synthetic rotations.
+
+    Returns:
+        dict: method -> list of (seconds, absolute angle error in degrees), one per image and angle.
+    """
+    results = {'full': [], 'pyramid': []}
+    for img in imgs:
+        for true_angle in angles:
+            rotated = np.asarray(synthetic_rotation(img, true_angle, upscale))
+            start = time.perf_counter()
+            angle = detect_rotation_angle(rotated)
+            results['full'].append((time.perf_counter() - start, abs(angle - true_angle)))
+            start = time.perf_counter()
+            angle, _ = detect_rotation_angle_pyramid(rotated)
+            results['pyramid'].append((time.perf_counter() - start, abs(angle - true_angle)))
+    return results
+
+def rotated_canvas_size(width, height, angle):
+    """Size of the canvas of a width x height image rotated by angle degrees, as PIL rotate(expand=True).
+
+    Same arithmetic as PIL: the absolute corners are rotated about (width / 2, height / 2) with
+    the matrix rounded to 15 decimals, and the extent is rounded outwards. The canvas minus the
+    image size is then even, so the image centre lands on whole-pixel offsets in the canvas.
+    Multiples of 90 degrees are transposes in PIL, with the sides swapped or kept.
+    """
+    if angle % 90 == 0:
+        # PIL transposes instead
+        return (height, width) if angle % 180 else (width, height)
+    a = -math.radians(angle)
+    matrix = [round(math.cos(a), 15), round(math.sin(a), 15), 0.0, round(-math.sin(a), 15), round(math.cos(a), 15), 0.0]
+
+    def transform(x, y):
+        return matrix[0] * x + matrix[1] * y + matrix[2], matrix[3] * x + matrix[4] * y + matrix[5]
+
+    matrix[2], matrix[5] = transform(-width / 2, -height / 2)
+    matrix[2] += width / 2
+    matrix[5] += height / 2
+    xx, yy = zip(*(transform(x, y) for x, y in ((0, 0), (width, 0), (width, height), (0, height))))
+    return math.ceil(max(xx)) - math.floor(min(xx)), math.ceil(max(yy)) - math.floor(min(yy))
+
+def largest_inscribed_box(width, height, angle):
+    """Largest axis-aligned (left, top, right, bottom) box of the rotated canvas holding only image pixels.
+
+    The box is centred in the canvas of rotated_canvas_size (the rotated image has no black fill
+    inside it), and shrunk by a pixel so that interpolation at its border stays within the image.
+    """
+    a = np.radians(angle)
+    sin_a, cos_a = abs(np.sin(a)), abs(np.cos(a))
+    long_side, short_side = max(width, height), min(width, height)
+    if short_side <= 2 * sin_a * cos_a * long_side or abs(sin_a - cos_a) < 1e-10:
+        # half constrained: two corners of the box touch the longer side
+        x = 0.5 * short_side
+        box_w, box_h = (x / sin_a, x / cos_a) if width >= height else (x / cos_a, x / sin_a)
+    else:
+        # fully constrained: all four corners touch the sides
+        cos_2a = cos_a * cos_a - sin_a * sin_a
+        box_w, box_h = (width * cos_a - height * sin_a) / cos_2a, (height * cos_a - width * sin_a) / cos_2a
+    if sin_a * cos_a > 1e-10:
+        box_w, box_h = box_w - 1, box_h - 1
+    box_w, box_h = max(1, int(box_w)), max(1, int(box_h))
+    canvas_w, canvas_h = rotated_canvas_size(width, height, angle)
+    left, top = (canvas_w - box_w) // 2, (canvas_h - box_h) // 2
+    return left, top, left + box_w, top + box_h
+
+def rotate_crop_array(image, angle, box=None, interpolation=cv2.INTER_LINEAR, fill=0, dst=None):
+    """Rotate an ndarray by angle degrees (counter-clockwise, as PIL) and crop it, in a single cv2.warpAffine.
+
+    Only the pixels of the output box are computed, so no enlarged canvas is allocated and no
+    black border is produced for later stages to process.
+
+    Args:
+        image (ndarray): 2D or HxWxC image.
+        angle (float): Rotation in degrees, counter-clockwise.
+        box (tuple | None): (left, top, right, bottom) in the canvas of rotate(expand=True),
+            see rotated_canvas_size. Default: largest_inscribed_box.
+        interpolation (int): OpenCV interpolation flag. Default: cv2.INTER_LINEAR.
+        fill (int | tuple): Value of the pixels of box outside of the image. Default: 0.
+        dst (ndarray | None): Output buffer of the box size.
+
+    Returns:
+        ndarray: The box of the rotated image.
+    """
+    height, width = image.shape[:2]
+    if box is None:
+        box = largest_inscribed_box(width, height, angle)
+    left, top, right, bottom = box
+    canvas_w, canvas_h = rotated_canvas_size(width, height, angle)
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    # image centre to canvas centre, then the box corner to the origin; as in PIL the shift is whole
+    # pixels, but for the 90/270 degree transposes of images with sides of different parity
+    matrix[0, 2] += (canvas_w - width) / 2 - left
+    matrix[1, 2] += (canvas_h - height) / 2 - top
+    # warpAffine takes the pixel centres as integer coordinates, the matrix is for pixel corners
+    matrix[:, 2] += matrix[:, :2].sum(axis=1) * 0.5 - 0.5
+    return cv2.warpAffine(image, matrix, (right - left, bottom - top), dst=dst, flags=interpolation,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=fill)
+
+def rotate_image(img, angle=None, crop=False, box=None, interpolation=cv2.INTER_LINEAR):
+    """Rotates an image based on the detected rotation angle and returns the corrected image.
+
+    With crop=True (or a box) the correction is done by rotate_crop_array: the largest box
+    without black fill (or the given box, see rotate_crop_array) is produced directly.
+    angle overrides the detection.
+    """
+    if angle is None:
+        angle = detect_rotation_angle(img)
+        print(f"Detected Rotation Angle: {angle:.2f} degrees")
+
+    # detect_rotation_angle measures the tilt clockwise, undo it counter-clockwise
+    if crop or box is not None:
+        return Image.fromarray(rotate_crop_array(np.asarray(img), angle, box, interpolation))
+    rotated_image = img.rotate(angle, expand=True, fillcolor=0 if img.mode in ('L', 'I', 'F') else (0, 0, 0))
+    return rotated_image
+
+INTERPOLATIONS = {'nearest': cv2.INTER_NEAREST, 'linear': cv2.INTER_LINEAR, 'cubic': cv2.INTER_CUBIC,
+                  'lanczos': cv2.INTER_LANCZOS4, 'area': cv2.INTER_AREA}
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Detect (and correct) the rotation of every image of a folder')
+    parser.add_argument('--imgs', type=str, help='Folder of input images')
+    parser.add_argument('--output', type=str, default=None, help='Write the corrected images here')
+    parser.add_argument('--method', type=str, default='pyramid', choices=['pyramid', 'full'],
+                        help='detect_rotation_angle_pyramid or detect_rotation_angle')
+    parser.add_argument('--crop', action='store_true', help='Crop to the largest box without black fill')
+    parser.add_argument('--interpolation', type=str, default='linear', choices=list(INTERPOLATIONS))
+    parser.add_argument('--acquisition', type=str, default=None,
+                        help='Regex on the file names; files with the same match (first group if any) come from '
+                             'the same acquisition and share the angle detected on the first of them')
+    parser.add_argument('--index', type=str, default=None,
+                        help='Sidecar index of detected angles by file hash, default: rotation_index.json in '
+                             '--output (or --imgs)')
+    parser.add_argument('--csv', type=str, default=None,
+                        help='CSV of angles and timings, default: rotation_angles.csv in --output (or --imgs)')
+    parser.add_argument('--force', action='store_true', help='Detect again even when the index has the angle')
+    parser.add_argument('--min_confidence', type=float, default=0.3,
+                        help='Do not correct files whose angle has a lower confidence (pyramid method only)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='Files handed to a worker at once, default: files / (4 * workers)')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Instead, benchmark the detection methods on synthetic rotations of --imgs')
+    parser.add_argument('--upscale', type=int, default=4, help='Upscaling of the images before rotating (--benchmark)')
+
+    args = parser.parse_args()
+    if args.imgs is None:
+        parser.error('--imgs is required')
+    sidecar_dir = args.output or args.imgs
+    args.index = args.index or os.path.join(sidecar_dir, 'rotation_index.json')
+    args.csv = args.csv or os.path.join(sidecar_dir, 'rotation_angles.csv')
+
+    return args
+
+def list_images(folder):
+    extensions = Image.registered_extensions()
+    return sorted(file for file in os.listdir(folder) if os.path.splitext(file)[1].lower() in extensions)
+
+def acquisition_of(file, pattern):
+    """Acquisition of a file: the match of pattern (its first group if any), or the file itself."""
+    match = re.search(pattern, file) if pattern is not None else None
+    if match is None:
+        return file
+    return match.group(1) if match.groups() else match.group(0)
+
+def load_angle_index(path):
+    """Index of detected angles: {file sha256: {'angle', 'confidence', 'method', 'file'}}."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_angle_index(index, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+# per-process state of the batch functions, set by init_worker
+_args = None
+
+def init_worker(args, single_threaded=True):
+    global _args
+    _args = args
+    if single_threaded:
+        # the processes already use every core, avoid oversubscribing with OpenCV threads
+        cv2.setNumThreads(1)
+
+def _error_message(e):
+    return ''.join(traceback.format_exception_only(type(e), e)).strip()
+
+def hash_file(file):
+    """(file, sha256, seconds, error) of one input."""
+    start = time.perf_counter()
+    try:
+        key = file_key(os.path.join(_args.imgs, file))
+    except Exception as e:
+        return file, None, time.perf_counter() - start, _error_message(e)
+    return file, key, time.perf_counter() - start, None
+
+def detect_file(file):
+    """(file, angle, confidence, seconds, error) of one input; the full method has no confidence."""
+    start = time.perf_counter()
+    try:
+        image = np.asarray(Image.open(os.path.join(_args.imgs, file)).convert('L'))
+        if _args.method == 'pyramid':
+            angle, confidence = detect_rotation_angle_pyramid(image)
+        else:
+            angle, confidence = float(detect_rotation_angle(image)), None
+    except Exception as e:
+        return file, None, None, time.perf_counter() - start, _error_message(e)
+    return file, angle, confidence, time.perf_counter() - start, None
+
+def correct_file(task):
+    """Rotate one input by its angle into the output folder; returns (file, seconds, error)."""
+    file, angle = task
+    start = time.perf_counter()
+    try:
+        img = Image.open(os.path.join(_args.imgs, file))
+        img = rotate_image(img, angle, crop=_args.crop, interpolation=INTERPOLATIONS[_args.interpolation])
+        img.save(os.path.join(_args.output, file))
+    except Exception as e:
+        return file, time.perf_counter() - start, _error_message(e)
+    return file, time.perf_counter() - start, None
+
+def run_batch(args, files, map_fn):
+    """Angles of files (index, acquisition or detection) and corrected images; returns (rows, failed).
+
+    Every file is hashed; an acquisition whose files are all missing from the index (for the
+    method) is detected once, on its first file, and the angle is reused for the others. Files
+    with an angle of their own in the index keep it. Angles with a confidence below
+    args.min_confidence are not corrected, their rows are marked 'low confidence'.
+    """
+    index = load_angle_index(args.index)
+    rows = {file: {'file': file, 'acquisition': acquisition_of(file, args.acquisition), 'angle': '',
+                   'confidence': '', 'source': '', 'skipped': '', 'hash_ms': '', 'detect_ms': '', 'rotate_ms': ''}
+            for file in files}
+    failed = {}
+
+    keys = {}
+    for file, key, seconds, error in map_fn(hash_file, files):
+        rows[file]['hash_ms'] = f'{seconds * 1e3:.2f}'
+        if error is not None:
+            failed[file] = error
+        else:
+            keys[file] = key
+
+    def indexed(file):
+        entry = index.get(keys.get(file))
+        return entry if entry is not None and entry['method'] == args.method and not args.force else None
+
+    acquisitions = {}
+    for file in files:
+        if file not in failed:
+            acquisitions.setdefault(rows[file]['acquisition'], []).append(file)
+    to_detect = []
+    for members in acquisitions.values():
+        if not any(indexed(file) for file in members):
+            to_detect.append(members[0])
+
+    for file, angle, confidence, seconds, error in map_fn(detect_file, to_detect):
+        rows[file]['detect_ms'] = f'{seconds * 1e3:.2f}'
+        if error is not None:
+            failed[file] = error
+        else:
+            index[keys[file]] = {'angle': angle, 'confidence': confidence, 'method': args.method, 'file': file}
+    if to_detect:
+        save_angle_index(index, args.index)
+
+    angles = {}
+    for members in acquisitions.values():
+        detected = [file for file in members if file in to_detect and file not in failed]
+        source = detected[0] if detected else next((file for file in members if indexed(file)), None)
+        if source is None:
+            for file in members:
+                failed.setdefault(file, f'no angle for acquisition {rows[file]["acquisition"]}')
+            continue
+        for file in members:
+            # a file's own angle wins over the one of its acquisition
+            if file in detected:
+                entry, entry_source = index[keys[file]], 'detected'
+            elif indexed(file):
+                entry, entry_source = indexed(file), 'index'
+            else:
+                entry, entry_source = index[keys[source]], 'acquisition'
+            rows[file].update(angle=f"{entry['angle']:.4f}",
+                              confidence='' if entry['confidence'] is None else f"{entry['confidence']:.3f}",
+                              source=entry_source)
+            if entry['confidence'] is not None and entry['confidence'] < args.min_confidence:
+                rows[file]['skipped'] = 'low confidence'
+            else:
+                angles[file] = entry['angle']
+
+    if args.output is not None:
+        for file, seconds, error in map_fn(correct_file, list(angles.items())):
+            rows[file]['rotate_ms'] = f'{seconds * 1e3:.2f}'
+            if error is not None:
+                failed[file] = error
+
+    return [rows[file] for file in files], failed
+
+if __name__ == '__main__':
+    args = get_args()
+    files = list_images(args.imgs)
+
+    if args.benchmark:
+        results = benchmark_rotation_detection([Image.open(os.path.join(args.imgs, file)) for file in files],
+                                               upscale=args.upscale)
+        for method, runs in results.items():
+            seconds, errors = np.array(runs).T
+            print(f'{method:8s} {seconds.mean() * 1e3:8.1f} ms/image  mean error {errors.mean():.3f} deg  '
+                  f'max error {errors.max():.3f} deg')
+        raise SystemExit
+
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+    if args.workers > 1:
+        chunksize = args.chunksize or max(1, len(files) // (4 * args.workers))
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(args,))
+        map_fn = lambda fn, items: pool.imap(fn, items, chunksize=chunksize)
+    else:
+        pool = None
+        init_worker(args, single_threaded=False)
+        map_fn = map
+
+    start = time.perf_counter()
+    rows, failed = run_batch(args, files, map_fn)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    with open(args.csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else ['file'])
+        writer.writeheader()
+        writer.writerows(rows)
+    sources = [row['source'] for row in rows if row['source']]
+    print(f"{len(files)} files in {time.perf_counter() - start:.2f}s: {sources.count('detected')} detected, "
+          f"{sources.count('index')} from the index, {sources.count('acquisition')} from their acquisition")
+    print(f"Angles written to: {args.csv}")
+    low_confidence = [row for row in rows if row['skipped'] == 'low confidence']
+    if low_confidence:
+        for row in low_confidence:
+            print(f"Low confidence, not corrected: {row['file']} (angle {row['angle']}, confidence {row['confidence']})")
+        print(f"{len(low_confidence)} of {len(files)} files below --min_confidence {args.min_confidence:g}")
+
+    if failed:
+        for file, error in failed.items():
+            print(f"Failed: {file}: {error}")
+        print(f"{len(failed)} of {len(files)} files failed")
+        sys.exit(1)
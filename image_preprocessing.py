@@ -1,130 +1,256 @@
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 from PIL import Image, ImageEnhance, ImageFilter
 import cv2
 import numpy as np
 
+# Every operation has an ndarray core, <name>_array(img_np, ..., dst=None), working on 2D uint8
+# arrays and writing into dst when OpenCV allows it, and the PIL factory <name>(...) returning
+# a processing(img) closure around it. preprocessing_pipeline.Pipeline chains the cores.
+
+def tiled_apply(func, img_np, halo, tile_size=512, workers=None, dst=None):
+    """Runs func on overlapping tiles of a 2D image on a thread pool and stitches the results.
+
+    Every tile is extended by halo pixels on each side (clipped at the image border) before
+    func is applied and the halo is cropped away again, so the result equals func(img_np) for
+    any func whose output pixel depends only on input pixels within halo of it and that pads the
+    image border the same way in both cases (true for the OpenCV filters, which release the GIL).
+
+    Args:
+        func (callable): func(tile) -> filtered tile of the same shape.
+        img_np (ndarray): Input image.
+        halo (int): Radius of the input neighborhood of an output pixel.
+        tile_size (int): Output tile size (without halo). Default: 512.
+        workers (int | None): Threads. Default: os.cpu_count().
+        dst (ndarray | None): Output array.
+    """
+    height, width = img_np.shape[:2]
+    if dst is None:
+        dst = np.empty_like(img_np)
+
+    def run(y0, x0):
+        y1, x1 = min(y0 + tile_size, height), min(x0 + tile_size, width)
+        ey0, ex0 = max(0, y0 - halo), max(0, x0 - halo)
+        ey1, ex1 = min(height, y1 + halo), min(width, x1 + halo)
+        out = func(np.ascontiguousarray(img_np[ey0:ey1, ex0:ex1]))
+        dst[y0:y1, x0:x1] = out[y0 - ey0:y1 - ey0, x0 - ex0:x1 - ex0]
+
+    with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        futures = [pool.submit(run, y0, x0) for y0 in range(0, height, tile_size) for x0 in range(0, width, tile_size)]
+        for future in futures:
+            future.result()
+    return dst
+
+def denoise_gaussianBlur_array(img_np, radius=2, dst=None):
+    # PIL's box-blur approximation has no identical OpenCV counterpart, keep PIL here
+    return np.asarray(Image.fromarray(img_np).filter(ImageFilter.GaussianBlur(radius=radius)))
+
 def denoise_gaussianBlur(radius=2):
     def processing(img):
         img_denoised = img.filter(ImageFilter.GaussianBlur(radius=radius))
         return img_denoised
     return processing
 
-def denoise_fastN1MeansDenoising(templateWindowSize=7, searchWindowSize=21):
+def denoise_fastN1MeansDenoising_array(img_np, templateWindowSize=7, searchWindowSize=21, dst=None,
+                                       tile_size=None, workers=None):
+    if tile_size:
+        # a pixel is compared with the template windows of all pixels in its search window
+        halo = searchWindowSize // 2 + templateWindowSize // 2
+        return tiled_apply(lambda tile: denoise_fastN1MeansDenoising_array(tile, templateWindowSize, searchWindowSize),
+                           img_np, halo, tile_size, workers, dst)
+    return cv2.fastNlMeansDenoising(img_np, dst, h=10,
+        templateWindowSize=templateWindowSize, searchWindowSize=searchWindowSize)
+
+def denoise_fastN1MeansDenoising(templateWindowSize=7, searchWindowSize=21, tile_size=None, workers=None):
     def processing(img):
-        img_np = np.array(img)
-        denoised = cv2.fastNlMeansDenoising(img_np, None, h=10, 
-            templateWindowSize=templateWindowSize, searchWindowSize=searchWindowSize)
+        denoised = denoise_fastN1MeansDenoising_array(np.asarray(img), templateWindowSize, searchWindowSize,
+                                                      tile_size=tile_size, workers=workers)
         output = Image.fromarray(denoised)
         return output
     return processing
 
+def denoise_medianBlur_array(img_np, kernel_size=3, dst=None):
+    return cv2.medianBlur(img_np, kernel_size, dst)
+
 def denoise_medianBlur(kernel_size=3):
     def processing(img):
-        img_np = np.array(img)
-        median_filtered = cv2.medianBlur(img_np, kernel_size)
+        median_filtered = denoise_medianBlur_array(np.asarray(img), kernel_size)
         output = Image.fromarray(median_filtered)
         return output
     return processing
 
-def denoise_bilateralFilter():
+def denoise_bilateralFilter_array(img_np, dst=None, tile_size=None, workers=None):
+    if tile_size:
+        # d=9: radius 4
+        return tiled_apply(denoise_bilateralFilter_array, img_np, 4, tile_size, workers, dst)
+    return cv2.bilateralFilter(img_np, d=9, sigmaColor=75, sigmaSpace=75, dst=dst)
+
+def denoise_bilateralFilter(tile_size=None, workers=None):
     def processing(img):
-        img_np = np.array(img)
-        smoothed = cv2.bilateralFilter(img_np, d=9, sigmaColor=75, sigmaSpace=75)
+        smoothed = denoise_bilateralFilter_array(np.asarray(img), tile_size=tile_size, workers=workers)
         output = Image.fromarray(smoothed)
         return output
     return processing
 
+def edge_unsharpMask_array(img_np, radius=2, percent=150, threshold=3, dst=None):
+    # PIL's unsharp mask has no identical OpenCV counterpart, keep PIL here
+    img = Image.fromarray(img_np)
+    return np.asarray(img.filter(ImageFilter.UnsharpMask(radius=radius, percent=percent, threshold=threshold)))
+
 def edge_unsharpMask(radius=2, percent=150, threshold=3):
     def processing(img):
         return img.filter(ImageFilter.UnsharpMask(radius=radius, percent=percent, threshold=threshold))
     return processing
 
+def edge_grayscale_erosion_array(img_np, kernel_size=3, iterations=1, custom_kernel_shape=None, dst=None):
+    kernel_shape = custom_kernel_shape
+    if kernel_shape == None:
+        kernel_shape = cv2.MORPH_RECT
+
+    kernel = cv2.getStructuringElement(kernel_shape, (kernel_size, kernel_size))
+    return cv2.erode(img_np, kernel, dst, iterations=iterations)
+
 def edge_grayscale_erosion(kernel_size=3, iterations=1, custom_kernel_shape=None):
     def processing(img):
-        img_np = np.array(img)
-        
-        kernel_shape = custom_kernel_shape
-        if kernel_shape == None:
-            kernel_shape = cv2.MORPH_RECT
-
-        kernel = cv2.getStructuringElement(kernel_shape, (kernel_size, kernel_size))
-        eroded_image = cv2.erode(img_np, kernel, iterations=iterations)
+        eroded_image = edge_grayscale_erosion_array(np.asarray(img), kernel_size, iterations, custom_kernel_shape)
         output = Image.fromarray(eroded_image)
         return output
     return processing
 
+def edge_mask_laplacian_array(img_np, dst=None):
+    laplacian = cv2.Laplacian(img_np, cv2.CV_64F)
+    return cv2.convertScaleAbs(laplacian, dst)
+
 def edge_mask_laplacian():
     def processing(img):
-        img_np = np.array(img)
-        laplacian = cv2.Laplacian(img_np, cv2.CV_64F)
-        laplacian = cv2.convertScaleAbs(laplacian)
+        laplacian = edge_mask_laplacian_array(np.asarray(img))
         output = Image.fromarray(laplacian)
         return output
     return processing
 
+def edge_mask_binary_erosion_array(img_np, kernel_size=5, iterations=1, custom_kernel_shape=None, dst=None):
+    _, binary_image = cv2.threshold(img_np, 127, 255, cv2.THRESH_BINARY)
+
+    kernel_shape = custom_kernel_shape
+    if kernel_shape == None:
+        kernel_shape = cv2.MORPH_RECT
+
+    kernel = cv2.getStructuringElement(kernel_shape, (kernel_size, kernel_size))
+    eroded_image = cv2.erode(binary_image, kernel, iterations=iterations)
+    # uint8 difference, so the convertScaleAbs of the original is a copy
+    return cv2.subtract(binary_image, eroded_image, dst)
+
 def edge_mask_binary_erosion(kernel_size=5, iterations=1, custom_kernel_shape=None):
     def processing(img):
-        img_np = np.array(img)
-        
-        _, binary_image = cv2.threshold(img_np, 127, 255, cv2.THRESH_BINARY)
-
-        kernel_shape = custom_kernel_shape
-        if kernel_shape == None:
-            kernel_shape = cv2.MORPH_RECT
-
-        kernel = cv2.getStructuringElement(kernel_shape, (kernel_size, kernel_size))
-        eroded_image = cv2.erode(binary_image, kernel, iterations=iterations)
-        enhanced_edges = cv2.subtract(binary_image, eroded_image)
-        enhanced_edges = cv2.convertScaleAbs(enhanced_edges)
+        enhanced_edges = edge_mask_binary_erosion_array(np.asarray(img), kernel_size, iterations, custom_kernel_shape)
         output = Image.fromarray(enhanced_edges)
         return output
     return processing
 
-def edge_mask_sobel_filter(kernel_size=3):
-    def processing(img):
-        img_np = np.array(img)
+def edge_mask_sobel_filter_array(img_np, kernel_size=3, dst=None):
+    sobel_x = cv2.Sobel(img_np, cv2.CV_64F, 1, 0, ksize=kernel_size)
+    sobel_x = cv2.convertScaleAbs(sobel_x)
 
-        sobel_x = cv2.Sobel(img_np, cv2.CV_64F, 1, 0, ksize=kernel_size)  
-        sobel_x = cv2.convertScaleAbs(sobel_x)
+    sobel_y = cv2.Sobel(img_np, cv2.CV_64F, 0, 1, ksize=kernel_size)
+    sobel_y = cv2.convertScaleAbs(sobel_y)
 
-        sobel_y = cv2.Sobel(img_np, cv2.CV_64F, 0, 1, ksize=kernel_size)
-        sobel_y = cv2.convertScaleAbs(sobel_y)
+    return cv2.addWeighted(sobel_x, 0.5, sobel_y, 0.5, 0, dst)
 
-        combined = cv2.addWeighted(sobel_x, 0.5, sobel_y, 0.5, 0)
+def edge_mask_sobel_filter(kernel_size=3):
+    def processing(img):
+        combined = edge_mask_sobel_filter_array(np.asarray(img), kernel_size)
         output = Image.fromarray(combined)
         return output
     return processing
 
-def edge_mask_scharr_filter():
-    def processing(img):
-        img_np = np.array(img)
+def edge_mask_scharr_filter_array(img_np, dst=None):
+    scharr_x = cv2.Scharr(img_np, cv2.CV_64F, 1, 0)
+    scharr_x = cv2.convertScaleAbs(scharr_x)
 
-        scharr_x = cv2.Scharr(img_np, cv2.CV_64F, 1, 0)
-        scharr_x = cv2.convertScaleAbs(scharr_x)
+    scharr_y = cv2.Scharr(img_np, cv2.CV_64F, 0, 1)
+    scharr_y = cv2.convertScaleAbs(scharr_y)
 
-        scharr_y = cv2.Scharr(img_np, cv2.CV_64F, 0, 1)
-        scharr_y = cv2.convertScaleAbs(scharr_y)
+    return cv2.addWeighted(scharr_x, 0.5, scharr_y, 0.5, 0, dst)
 
-        combined = cv2.addWeighted(scharr_x, 0.5, scharr_y, 0.5, 0)
+def edge_mask_scharr_filter():
+    def processing(img):
+        combined = edge_mask_scharr_filter_array(np.asarray(img))
         output = Image.fromarray(combined)
         return output
     return processing
 
-def contrast_clahe(clipLimit=2.0, tileGridSize=8):
+def _contrast_clahe_tiled(img_np, clipLimit, tileGridSize, dst, tile_size, workers):
+    """contrast_clahe in chunks of whole CLAHE tiles.
+
+    A pixel is interpolated from the histograms of the (up to) four nearest CLAHE tiles, so a
+    chunk is processed together with one CLAHE tile of halo on every side. Like OpenCV, the
+    image is first padded at the bottom/right to a multiple of the tile grid. The histograms
+    are identical to one clahe.apply, but OpenCV computes the interpolation weights from float
+    coordinates relative to the chunk, so a small fraction of pixels can differ by one grey level.
+    """
+    height, width = img_np.shape
+    if height % tileGridSize or width % tileGridSize:
+        # OpenCV pads both sides by tiles - size % tiles, a whole tile on an already divisible side
+        pad_y, pad_x = tileGridSize - height % tileGridSize, tileGridSize - width % tileGridSize
+        padded = cv2.copyMakeBorder(img_np, 0, pad_y, 0, pad_x, cv2.BORDER_REFLECT_101)
+    else:
+        padded = img_np
+    tile_h, tile_w = padded.shape[0] // tileGridSize, padded.shape[1] // tileGridSize
+    chunk_y, chunk_x = max(1, tile_size // tile_h), max(1, tile_size // tile_w)
+    if dst is None:
+        dst = np.empty_like(img_np)
+
+    def run(ty0, tx0):
+        ty1, tx1 = min(ty0 + chunk_y, tileGridSize), min(tx0 + chunk_x, tileGridSize)
+        ey0, ex0 = max(0, ty0 - 1), max(0, tx0 - 1)
+        ey1, ex1 = min(tileGridSize, ty1 + 1), min(tileGridSize, tx1 + 1)
+        clahe = cv2.createCLAHE(clipLimit=clipLimit, tileGridSize=(ex1 - ex0, ey1 - ey0))
+        out = clahe.apply(np.ascontiguousarray(padded[ey0 * tile_h:ey1 * tile_h, ex0 * tile_w:ex1 * tile_w]))
+        y0, y1 = ty0 * tile_h, min(ty1 * tile_h, height)
+        x0, x1 = tx0 * tile_w, min(tx1 * tile_w, width)
+        dst[y0:y1, x0:x1] = out[y0 - ey0 * tile_h:y1 - ey0 * tile_h, x0 - ex0 * tile_w:x1 - ex0 * tile_w]
+
+    with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        futures = [pool.submit(run, ty0, tx0)
+                   for ty0 in range(0, tileGridSize, chunk_y) for tx0 in range(0, tileGridSize, chunk_x)]
+        for future in futures:
+            future.result()
+    return dst
+
+def contrast_clahe_array(img_np, clipLimit=2.0, tileGridSize=8, dst=None, tile_size=None, workers=None):
+    if tile_size:
+        return _contrast_clahe_tiled(img_np, clipLimit, tileGridSize, dst, tile_size, workers)
+    clahe = cv2.createCLAHE(clipLimit=clipLimit, tileGridSize=(tileGridSize,tileGridSize))
+    return clahe.apply(img_np, dst)
+
+def contrast_clahe(clipLimit=2.0, tileGridSize=8, tile_size=None, workers=None):
     def processing(img):
-        img_np = np.array(img)
-        
-        clahe = cv2.createCLAHE(clipLimit=clipLimit, tileGridSize=(tileGridSize,tileGridSize))
-        clahe_img = clahe.apply(img_np)
-        
+        clahe_img = contrast_clahe_array(np.asarray(img), clipLimit, tileGridSize, tile_size=tile_size, workers=workers)
+
         output = Image.fromarray(clahe_img)
 
         return output
     return processing
 
+# Point operations on uint8 also have a cached 256-entry LUT, <name>_lut(...), so the pipeline
+# can compose consecutive ones into a single cv2.LUT pass.
+
+def _read_only(lut):
+    lut.setflags(write=False)
+    return lut
+
+@functools.lru_cache(maxsize=64)
+def contrast_gamma_correction_lut(gamma=0.8):
+    return _read_only(np.array([int((i / 255.0) ** gamma * 255) for i in range(256)], dtype=np.uint8))
+
+def contrast_gamma_correction_array(img_np, gamma=0.8, dst=None):
+    return cv2.LUT(img_np, contrast_gamma_correction_lut(gamma), dst)
+
 def contrast_gamma_correction(gamma = 0.8):
     def processing(img):
-        lut = [int((i / 255.0) ** gamma * 255) for i in range(256)]
-        img_out = img.point(lut)
+        img_out = Image.fromarray(contrast_gamma_correction_array(np.asarray(img), gamma))
         return img_out
     return processing
 
@@ -140,30 +266,57 @@ def mask_combine(mask):
         return output
     return processing
 
+@functools.lru_cache(maxsize=64)
+def misc_convert_binary_lut(threshold=50):
+    # cv2.threshold compares 8-bit images against floor(threshold)
+    values = np.arange(256)
+    return _read_only(np.where(values > np.floor(threshold), 255, 0).astype(np.uint8))
+
+def misc_convert_binary_array(img_np, threshold=50, dst=None):
+    _, edge_mask = cv2.threshold(img_np, threshold, 255, cv2.THRESH_BINARY, dst)
+    return edge_mask
+
 def misc_convert_binary(threshold=50):
     def processing(img):
-        img_np = np.array(img)
-        _, edge_mask = cv2.threshold(img_np, threshold, 255, cv2.THRESH_BINARY)
+        edge_mask = misc_convert_binary_array(np.asarray(img), threshold)
         output = Image.fromarray(edge_mask)
         return output
     return processing
 
+@functools.lru_cache(maxsize=256)
+def misc_normalise_img_lut(img_min, img_max, target_min = 0, target_max = 255):
+    """misc_normalise_img of a uint8 image whose pixel values span img_min..img_max."""
+    if img_max == img_min:
+        return _read_only(np.full(256, target_min, dtype=np.uint8))
+    # values outside img_min..img_max do not occur, clip them to keep the cast defined
+    values = np.clip(np.arange(256, dtype=np.float32), img_min, img_max)
+    normalized = target_min + (values - img_min) * (target_max - target_min) / (img_max - img_min)
+    return _read_only(normalized.astype(np.uint8))
+
+def misc_normalise_img_array(img_np, target_min = 0, target_max = 255, dst=None):
+    # Find minimum and maximum pixel values in the image (minMaxLoc is single-channel, flatten colour images)
+    img_min, img_max, _, _ = cv2.minMaxLoc(img_np.reshape(-1))
+
+    if img_np.dtype == np.uint8:
+        return cv2.LUT(img_np, misc_normalise_img_lut(int(img_min), int(img_max), target_min, target_max), dst)
+
+    # Avoid division by zero for uniform images
+    if img_max == img_min:
+        if dst is None:
+            return np.full_like(img_np, target_min, dtype=np.uint8)  # Uniform image
+        dst[...] = target_min
+        return dst
+
+    # Apply min-max normalization
+    normalized_image = target_min + (img_np.astype(np.float32) - img_min) * (target_max - target_min) / (img_max - img_min)
+    if dst is None:
+        return normalized_image.astype(np.uint8)
+    dst[...] = normalized_image
+    return dst
+
 def misc_normalise_img(target_min = 0, target_max = 255):
     def processing(img):
-        img_np = np.array(img)
-        img_np = img_np.astype(np.float32)
-    
-        # Find minimum and maximum pixel values in the image
-        img_min = np.min(img_np)
-        img_max = np.max(img_np)
-        
-        # Avoid division by zero for uniform images
-        if img_max == img_min:
-            return np.full_like(img_np, target_min, dtype=np.float32)  # Uniform image
-
-        # Apply min-max normalization
-        normalized_image = target_min + (img_np - img_min) * (target_max - target_min) / (img_max - img_min)
-        normalized_image = normalized_image.astype(np.uint8)
+        normalized_image = misc_normalise_img_array(np.asarray(img), target_min, target_max)
         output = Image.fromarray(normalized_image)
         return output
-    return processing
\ No newline at end of file
+    return processing
@@ -0,0 +1,169 @@
+import argparse
+import copy
+import os
+import time
+
+import torch
+
+from main_test_swinir import define_model, setup, test
+from utils.util_autotune import DEFAULT_PROFILE_DIR, save_settings
+from utils.util_benchmark import PeakMemoryMonitor
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Pick the fastest threads/tile/tile batch for a task on this host.')
+    parser.add_argument('--task', type=str, default='color_dn', help='classical_sr, lightweight_sr, real_sr, '
+                                                                     'gray_dn, color_dn, jpeg_car, color_jpeg_car')
+    parser.add_argument('--scale', type=int, default=1, help='scale factor: 1, 2, 3, 4, 8')
+    parser.add_argument('--noise', type=int, default=15, help='noise level: 15, 25, 50')
+    parser.add_argument('--jpeg', type=int, default=40, help='scale factor: 10, 20, 30, 40')
+    parser.add_argument('--training_patch_size', type=int, default=128)
+    parser.add_argument('--large_model', action='store_true', help='use large model, only provided for real image sr')
+    parser.add_argument('--model_path', type=str, required=True,
+                        help='weights the profile is keyed on, the --model_path main_test_swinir.py runs with')
+    parser.add_argument('--folder_lq', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--folder_gt', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--tile_overlap', type=int, default=32, help='Overlapping of different tiles')
+    parser.add_argument('--image_size', type=int, default=256, help='typical input (low-quality) image size')
+    parser.add_argument('--memory_budget_mb', type=float, default=None, help='peak memory budget of a trial')
+    parser.add_argument('--threads', nargs='+', type=int, default=None, help='candidate torch thread counts')
+    parser.add_argument('--tiles', nargs='+', type=int, default=None, help='candidate tile sizes, 0 for no tile')
+    parser.add_argument('--tile_batches', nargs='+', type=int, default=[1, 2, 4], help='candidate tiles per forward')
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs per trial')
+    parser.add_argument('--profile_dir', type=str, default=DEFAULT_PROFILE_DIR)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def default_threads():
+    cores = os.cpu_count() or 1
+    threads = [1]
+    while threads[-1] * 2 <= cores:
+        threads.append(threads[-1] * 2)
+    if threads[-1] != cores:
+        threads.append(cores)
+    return threads
+
+
+def default_tiles(image_size, window_size, tile_overlap):
+    tiles = [0]
+    tile = 64
+    while tile < image_size:
+        tile_ws = tile // window_size * window_size
+        if tile_ws > tile_overlap:
+            tiles.append(tile_ws)
+        tile *= 2
+    return tiles
+
+
+def trial(model, args, window_size, img_lq, device, repeat=1):
+    """Time test() with the options in ``args``; returns (seconds per image, peak memory bytes)."""
+    with torch.no_grad():
+        test(img_lq, model, args, window_size)  # warmup
+        with PeakMemoryMonitor(device) as memory:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                test(img_lq, model, args, window_size)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            latency = (time.perf_counter() - start) / repeat
+    return latency, memory.peak_bytes
+
+
+def autotune(model, args, window_size, device, image_size=256, memory_budget=None, threads=None, tiles=None,
+             tile_batches=(1, 2, 4), repeat=1, fixed_tiling=False, verbose=True):
+    """Search threads, tile and tile batch for the lowest latency within a memory budget.
+
+    The search runs in two stages to keep it short: tile size and tile batch are tried with
+    the largest thread count, then the thread count is swept with the best tile setting.
+    The inter-op thread count is not searched (torch allows setting it once per process); a
+    single inter-op thread is recorded since the eager SwinIR forward has no inter-op work.
+
+    Args:
+        model (nn.Module): Model built by define_model.
+        args (Namespace): Options of main_test_swinir (task, scale, tile_overlap, ...).
+        window_size (int): Window size returned by setup.
+        device (torch.device): Device to tune on.
+        image_size (int): Typical input image size. Default: 256.
+        memory_budget (float | None): Peak memory budget in bytes. Default: no budget.
+        threads (list[int] | None): Candidate torch thread counts. Default: powers of two up to the core count.
+        tiles (list[int] | None): Candidate tiles, 0 for none. Default: 0 and 64, 128, ... below image_size.
+        tile_batches (list[int]): Candidate tiles per forward pass. Default: (1, 2, 4).
+        repeat (int): Timed runs per trial. Default: 1.
+        fixed_tiling (bool): Keep the tiling options of ``args`` (tile, tile_h, tile_w, strip) instead of
+            searching square tiles; only the tile batch and threads are tuned. Default: False.
+
+    Returns:
+        dict: Settings for apply_settings, with the measured latency and peak memory.
+    """
+    threads = threads or default_threads()
+    if fixed_tiling:
+        tiles = [True]  # the tiling of args, tried with every tile batch
+    elif tiles is None:
+        tiles = default_tiles(image_size, window_size, args.tile_overlap)
+    size = -(-image_size // window_size) * window_size
+    in_chans = 1 if args.task in ['gray_dn', 'jpeg_car'] else 3
+    img_lq = torch.rand(1, in_chans, size, size, device=device)
+
+    def run(n_threads, tile, tile_batch):
+        torch.set_num_threads(n_threads)
+        targs = copy.copy(args)
+        if not fixed_tiling:
+            targs.tile = tile or None
+        targs.tile_batch = tile_batch
+        latency, peak = trial(model, targs, window_size, img_lq, device, repeat)
+        fits = memory_budget is None or peak <= memory_budget
+        if verbose:
+            print('threads {:3d} tile {:>4} tile batch {:2d} - {:9.1f} ms; peak {:8.1f} MB{}'.format(
+                n_threads, 'user' if fixed_tiling else tile or 0, tile_batch, latency * 1e3, peak / 2 ** 20,
+                '' if fits else ' (over budget)'))
+        return {'threads': n_threads, 'tile': targs.tile, 'tile_batch': tile_batch,
+                'latency': latency, 'peak_mem_bytes': peak, 'fits': fits}
+
+    # stage 1: tile and tile batch at the largest thread count
+    candidates = []
+    for tile in tiles:
+        for tile_batch in (tile_batches if tile else [1]):
+            candidates.append(run(max(threads), tile, tile_batch))
+    fitting = [c for c in candidates if c['fits']] or [min(candidates, key=lambda c: c['peak_mem_bytes'])]
+    best = min(fitting, key=lambda c: c['latency'])
+
+    # stage 2: thread count with the best tile setting
+    for n_threads in threads:
+        if n_threads != best['threads']:
+            candidate = run(n_threads, best['tile'], best['tile_batch'])
+            if candidate['fits'] and candidate['latency'] < best['latency']:
+                best = candidate
+
+    return {'threads': best['threads'], 'interop_threads': 1, 'cv2_threads': best['threads'],
+            'tile': best['tile'], 'tile_batch': best['tile_batch'], 'image_size': image_size,
+            'latency': best['latency'], 'peak_mem_bytes': best['peak_mem_bytes'],
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def main():
+    args = get_args()
+    device = torch.device(args.device)
+    model_path = args.model_path
+    if model_path is not None and not os.path.exists(model_path):
+        raise FileNotFoundError(f'model {model_path} not found')
+
+    model = define_model(args)
+    model.eval()
+    model = model.to(device)
+    _, _, _, window_size = setup(args)
+
+    memory_budget = args.memory_budget_mb * 2 ** 20 if args.memory_budget_mb else None
+    settings = autotune(model, args, window_size, device, image_size=args.image_size, memory_budget=memory_budget,
+                        threads=args.threads, tiles=args.tiles, tile_batches=args.tile_batches, repeat=args.repeat)
+    path = save_settings(args, settings, args.profile_dir)
+    print('\nbest: threads {} tile {} tile batch {} - {:.1f} ms per image'.format(
+        settings['threads'], settings['tile'], settings['tile_batch'], settings['latency'] * 1e3))
+    print(f'profile written to {path}')
+
+
+if __name__ == '__main__':
+    main()
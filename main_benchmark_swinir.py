@@ -0,0 +1,137 @@
+import argparse
+import itertools
+import time
+from types import SimpleNamespace
+
+import torch
+
+from main_test_swinir import define_model, setup, test
+from utils.util_benchmark import PeakMemoryMonitor, host_fingerprint, host_info, save_results
+
+
+# every configuration built by define_model, keyed by benchmark name
+BENCHMARK_CONFIGS = {
+    'classical_sr_x2': dict(task='classical_sr', scale=2),
+    'classical_sr_x3': dict(task='classical_sr', scale=3),
+    'classical_sr_x4': dict(task='classical_sr', scale=4),
+    'classical_sr_x8': dict(task='classical_sr', scale=8),
+    'lightweight_sr_x2': dict(task='lightweight_sr', scale=2),
+    'lightweight_sr_x3': dict(task='lightweight_sr', scale=3),
+    'lightweight_sr_x4': dict(task='lightweight_sr', scale=4),
+    'real_sr_x4': dict(task='real_sr', scale=4),
+    'real_sr_x4_large': dict(task='real_sr', scale=4, large_model=True),
+    'gray_dn': dict(task='gray_dn', scale=1),
+    'color_dn': dict(task='color_dn', scale=1),
+    'jpeg_car': dict(task='jpeg_car', scale=1),
+    'color_jpeg_car': dict(task='color_jpeg_car', scale=1),
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark every SwinIR configuration with random weights.')
+    parser.add_argument('--configs', nargs='+', default=list(BENCHMARK_CONFIGS),
+                        choices=list(BENCHMARK_CONFIGS), help='configurations to benchmark')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[64, 128],
+                        help='input (low-quality) image sizes, rounded up to a multiple of window_size')
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1])
+    parser.add_argument('--tiles', nargs='+', type=int, default=[0],
+                        help='tile sizes, 0 for no tile; rounded down to a multiple of window_size')
+    parser.add_argument('--tile_overlap', type=int, default=32, help='Overlapping of different tiles')
+    parser.add_argument('--threads', nargs='+', type=int, default=[torch.get_num_threads()],
+                        help='values for torch.set_num_threads')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed runs before measuring')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per setting')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--output', type=str, default=None,
+                        help='results JSON, default: results/benchmark/<host fingerprint>.json')
+    args = parser.parse_args()
+
+    return args
+
+
+def model_args(name, tile=None, tile_overlap=32):
+    """Namespace accepted by define_model/setup/test for a benchmark configuration (no weights)."""
+    config = BENCHMARK_CONFIGS[name]
+    return SimpleNamespace(task=config['task'], scale=config['scale'], noise=15, jpeg=40,
+                           training_patch_size=128 if config['task'] == 'classical_sr' else 64,
+                           large_model=config.get('large_model', False), model_path=None,
+                           folder_lq=None, folder_gt=None, tile=tile, tile_overlap=tile_overlap)
+
+
+def in_channels(task):
+    return 1 if task in ['gray_dn', 'jpeg_car'] else 3
+
+
+def benchmark_setting(model, args, window_size, batch_size, size, device, warmup=1, repeat=3):
+    """Time ``repeat`` tiled/whole-image forwards of a random input of ``size`` x ``size``.
+
+    Returns:
+        dict: per-run latencies (s), mean latency, output megapixels per second, per-run and overall
+            peak memory.
+    """
+    size = -(-size // window_size) * window_size
+    img_lq = torch.rand(batch_size, in_channels(args.task), size, size, device=device)
+
+    with torch.no_grad():
+        for _ in range(warmup):
+            test(img_lq, model, args, window_size)
+
+        latencies, peak_mems = [], []
+        for _ in range(repeat):
+            # peak memory per run, so compare_results can estimate its noise as for the latency
+            with PeakMemoryMonitor(device) as memory:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                start = time.perf_counter()
+                test(img_lq, model, args, window_size)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                latencies.append(time.perf_counter() - start)
+            peak_mems.append(memory.peak_bytes)
+
+    latency = sum(latencies) / len(latencies)
+    out_mpix = batch_size * (size * args.scale) ** 2 / 1e6
+    return {'size': size, 'latencies': latencies, 'latency': latency,
+            'throughput_mpix_s': out_mpix / latency, 'peak_mems': peak_mems, 'peak_mem_bytes': max(peak_mems)}
+
+
+def main():
+    args = get_args()
+    device = torch.device(args.device)
+    info = host_info()
+    output = args.output or f'results/benchmark/{host_fingerprint(info)}.json'
+    print(f"host: {info['cpu']} ({info['cores']} cores), torch {info['torch']}")
+
+    results = []
+    for name in args.configs:
+        margs = model_args(name, tile_overlap=args.tile_overlap)
+        model = define_model(margs)
+        model.eval()
+        model = model.to(device)
+        _, _, _, window_size = setup(margs)
+
+        for threads, batch_size, size, tile in itertools.product(args.threads, args.batch_sizes, args.sizes, args.tiles):
+            torch.set_num_threads(threads)
+            margs.tile = tile // window_size * window_size if tile else None
+            if margs.tile is not None and margs.tile - margs.tile_overlap <= 0:
+                print(f'skip {name}: tile {margs.tile} not larger than overlap {margs.tile_overlap}')
+                continue
+
+            result = benchmark_setting(model, margs, window_size, batch_size, size, device,
+                                       warmup=args.warmup, repeat=args.repeat)
+            result.update({'config': name, 'task': margs.task, 'scale': margs.scale, 'large_model': margs.large_model,
+                           'batch': batch_size, 'tile': margs.tile or 0, 'threads': threads, 'device': str(device)})
+            results.append(result)
+            print('{:18s} size {:4d} batch {:2d} tile {:4d} threads {:2d} - {:9.1f} ms; {:7.3f} Mpix/s; '
+                  'peak {:8.1f} MB'.format(name, result['size'], batch_size, result['tile'], threads,
+                                           result['latency'] * 1e3, result['throughput_mpix_s'],
+                                           result['peak_mem_bytes'] / 2 ** 20))
+
+        del model
+
+    save_results(output, results, info)
+    print(f'\nresults written to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import os
+import shutil
+import sys
+
+from utils.util_benchmark import baseline_path, compare_results, host_fingerprint, load_results
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Compare a benchmark run of main_benchmark_swinir.py against a '
+                                                 'baseline and exit non-zero on regressions.')
+    parser.add_argument('results', type=str, help='results JSON of the candidate run')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='baseline results JSON, default: the stored baseline for the host fingerprint')
+    parser.add_argument('--baseline_dir', type=str, default='benchmarks/baselines',
+                        help='directory of per-host baselines (<fingerprint>.json)')
+    parser.add_argument('--save_baseline', action='store_true',
+                        help='store the candidate run as the baseline for its host fingerprint and exit')
+    parser.add_argument('--threshold', type=float, default=0.05, help='minimum relative latency/throughput change')
+    parser.add_argument('--noise_sigmas', type=float, default=3., help='noise multiplier of the adaptive thresholds')
+    parser.add_argument('--mem_threshold', type=float, default=0.10, help='minimum relative peak memory change')
+    parser.add_argument('--mem_floor_mb', type=float, default=32.,
+                        help='peak memory growth (MB) below which a memory change is only a warning')
+    parser.add_argument('--allow_host_mismatch', action='store_true',
+                        help='compare runs from hosts with different fingerprints')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    args = get_args()
+    new = load_results(args.results)
+    fingerprint = new.get('fingerprint') or host_fingerprint(new['host'])
+
+    if args.save_baseline:
+        path = baseline_path(args.baseline_dir, fingerprint)
+        os.makedirs(args.baseline_dir, exist_ok=True)
+        shutil.copyfile(args.results, path)
+        print(f'baseline for host {fingerprint} stored at {path}')
+        return 0
+
+    path = args.baseline or baseline_path(args.baseline_dir, fingerprint)
+    if not os.path.exists(path):
+        print(f'no baseline for host {fingerprint} at {path}; store one with --save_baseline')
+        return 2
+    base = load_results(path)
+    base_fingerprint = base.get('fingerprint') or host_fingerprint(base['host'])
+    if base_fingerprint != fingerprint and not args.allow_host_mismatch:
+        print(f'baseline host {base_fingerprint} differs from candidate host {fingerprint} '
+              f'({base["host"]} vs {new["host"]}); use --allow_host_mismatch to compare anyway')
+        return 2
+
+    rows = compare_results(base['results'], new['results'], threshold=args.threshold,
+                           noise_sigmas=args.noise_sigmas, mem_threshold=args.mem_threshold,
+                           mem_floor=args.mem_floor_mb * 2 ** 20)
+    if not rows:
+        print('no common settings between baseline and candidate')
+        return 2
+
+    print('{:18s} {:>5s} {:>5s} {:>5s} {:>7s}  {:>9s} {:>11s} {:>7s} {:>9s} {:>9s}  {}'.format(
+        'config', 'size', 'batch', 'tile', 'threads', 'latency', 'throughput', 'limit', 'peak mem', 'mem limit',
+        'status'))
+    for row in rows:
+        config, size, batch, tile, threads, _ = row['key']
+        flagged = row['regressed'] + row['warned']
+        status = row['status'] + (' (' + ', '.join(flagged) + ')' if flagged else '')
+        print('{:18s} {:5d} {:5d} {:5d} {:7d}  {:+8.1%} {:+10.1%} {:6.1%} {:+8.1%} {:8.1%}  {}'.format(
+            config, size, batch, tile, threads, row['latency_delta'], row['throughput_delta'], row['limit'],
+            row['mem_delta'], row['mem_limit'], status))
+
+    regressions = [row for row in rows if row['status'] == 'regression']
+    warnings = [row for row in rows if row['status'] == 'warning']
+    print(f'\n{len(regressions)} regression(s), {len(warnings)} peak memory warning(s) below the '
+          f'{args.mem_floor_mb:g} MB floor in {len(rows)} compared setting(s)')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,255 @@
+import argparse
+import copy
+import glob
+import os
+import sys
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from main_benchmark_swinir import BENCHMARK_CONFIGS, model_args
+from main_test_swinir import define_model, get_image_pair, setup, test
+from utils import util_calculate_psnr_ssim as util
+
+
+# bundled test sets used for every task (folder_gt, folder_lq)
+TESTSETS = {
+    'classical_sr': ('testsets/Set5/HR', 'testsets/Set5/LR_bicubic/X{scale}'),
+    'lightweight_sr': ('testsets/Set5/HR', 'testsets/Set5/LR_bicubic/X{scale}'),
+    'real_sr': (None, 'testsets/RealSRSet+5images'),
+    'gray_dn': ('testsets/Set12', None),
+    'color_dn': ('testsets/McMaster', None),
+    'jpeg_car': ('testsets/classic5', None),
+    'color_jpeg_car': ('testsets/classic5', None),
+}
+
+
+def mode_tile(model, args, window_size):
+    """Tiled inference with main_test_swinir.test."""
+    tile_args = copy.copy(args)
+    tile_args.tile = args.mode_tile // window_size * window_size
+    return lambda img_lq: test(img_lq, model, tile_args, window_size)
+
+
+def reference_tile(model, args, window_size):
+    """Tiled inference as main_test_swinir.test was written originally: square tiles, one at a time.
+
+    The reference of the tile mode, so that the comparison only measures seams and overlap
+    weighting, not the receptive field the tiles cut off.
+    """
+    tile, tile_overlap, sf = args.mode_tile // window_size * window_size, args.tile_overlap, args.scale
+
+    def forward(img_lq):
+        b, c, h, w = img_lq.size()
+        size = min(tile, h, w)
+        h_idx_list = list(range(0, h - size, size - tile_overlap)) + [h - size]
+        w_idx_list = list(range(0, w - size, size - tile_overlap)) + [w - size]
+        E = torch.zeros(b, c, h * sf, w * sf).type_as(img_lq)
+        W = torch.zeros_like(E)
+        for h_idx in h_idx_list:
+            for w_idx in w_idx_list:
+                out_patch = model(img_lq[..., h_idx:h_idx + size, w_idx:w_idx + size])
+                E[..., h_idx * sf:(h_idx + size) * sf, w_idx * sf:(w_idx + size) * sf].add_(out_patch)
+                W[..., h_idx * sf:(h_idx + size) * sf, w_idx * sf:(w_idx + size) * sf].add_(1)
+        return E.div_(W)
+    return forward
+
+
+def mode_bf16(model, args, window_size):
+    """bfloat16 autocast on the model's device."""
+    def forward(img_lq):
+        with torch.autocast(device_type=img_lq.device.type, dtype=torch.bfloat16):
+            return model(img_lq).float()
+    return forward
+
+
+def mode_dynamic_int8(model, args, window_size):
+    """Dynamic int8 quantization of all nn.Linear layers (CPU only)."""
+    qmodel = torch.quantization.quantize_dynamic(copy.deepcopy(model).cpu(), {nn.Linear}, dtype=torch.qint8)
+    return lambda img_lq: qmodel(img_lq.cpu()).to(img_lq.device)
+
+
+def mode_channels_last(model, args, window_size):
+    """channels_last memory format for the convolutions."""
+    cl_model = copy.deepcopy(model).to(memory_format=torch.channels_last)
+    return lambda img_lq: cl_model(img_lq.contiguous(memory_format=torch.channels_last))
+
+
+# candidate inference modes, the tolerances they must meet and their reference (None: the eager model):
+#   max_abs: maximum absolute difference of the float outputs in [0, 1]
+#   min_psnr: minimum PSNR (dB) between the uint8 outputs
+#   max_gt_delta: maximum |PSNR-vs-GT difference| (dB), only checked when GT exists
+# tiling is compared with the same tiles run one by one, so a seam or overlap error fails it; the
+# difference left is float summation order, well below 1/255
+MODES = {
+    'tile': (mode_tile, dict(max_abs=2 / 255, min_psnr=55., max_gt_delta=0.01), reference_tile),
+    'bf16': (mode_bf16, dict(max_abs=0.1, min_psnr=35., max_gt_delta=0.1), None),
+    'dynamic_int8': (mode_dynamic_int8, dict(max_abs=0.2, min_psnr=30., max_gt_delta=0.3), None),
+    'channels_last': (mode_channels_last, dict(max_abs=1e-4, min_psnr=60., max_gt_delta=0.001), None),
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Check that a fast inference mode gives the same results as its '
+                                                 'reference (the eager SwinIR, or for tiling the same tiles run one '
+                                                 'by one) on the bundled test sets.')
+    parser.add_argument('--modes', nargs='+', default=['tile'], choices=list(MODES), help='candidate modes')
+    parser.add_argument('--configs', nargs='+', default=['classical_sr_x2', 'lightweight_sr_x2', 'real_sr_x4',
+                                                           'gray_dn', 'color_dn', 'jpeg_car', 'color_jpeg_car'],
+                        choices=list(BENCHMARK_CONFIGS))
+    parser.add_argument('--model_path', type=str, default=None,
+                        help='real weights (only with a single config); default: random weights from --seed')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random weights')
+    parser.add_argument('--max_images', type=int, default=2, help='images per test set, 0 for all')
+    parser.add_argument('--crop', type=int, default=64, help='center crop of the LQ input, 0 for the whole image')
+    parser.add_argument('--mode_tile', type=int, default=48, help='tile size of the tile mode')
+    parser.add_argument('--tile_overlap', type=int, default=16, help='tile overlap of the tile mode')
+    parser.add_argument('--device', type=str, default='cpu')
+
+    args = parser.parse_args()
+    if args.model_path is not None and len(args.configs) != 1:
+        parser.error('--model_path requires exactly one config')
+
+    return args
+
+
+def center_crop(img_lq, img_gt, crop, scale):
+    h, w = img_lq.shape[:2]
+    if crop <= 0 or (h <= crop and w <= crop):
+        return img_lq, img_gt
+    top, left = max(0, (h - crop) // 2), max(0, (w - crop) // 2)
+    img_lq = img_lq[top:top + crop, left:left + crop, ...]
+    if img_gt is not None:
+        img_gt = img_gt[top * scale:(top + crop) * scale, left * scale:(left + crop) * scale, ...]
+    return img_lq, img_gt
+
+
+def run(forward, img_lq, window_size, scale):
+    """Pad like main_test_swinir, run ``forward`` and return the HWC-BGR float output in [0, 1]."""
+    with torch.no_grad():
+        _, _, h_old, w_old = img_lq.size()
+        h_pad = (h_old // window_size + 1) * window_size - h_old
+        w_pad = (w_old // window_size + 1) * window_size - w_old
+        img_lq = torch.cat([img_lq, torch.flip(img_lq, [2])], 2)[:, :, :h_old + h_pad, :]
+        img_lq = torch.cat([img_lq, torch.flip(img_lq, [3])], 3)[:, :, :, :w_old + w_pad]
+        output = forward(img_lq)
+        output = output[..., :h_old * scale, :w_old * scale]
+
+    output = output.data.squeeze().float().cpu().clamp_(0, 1).numpy()
+    if output.ndim == 3:
+        output = np.transpose(output[[2, 1, 0], :, :], (1, 2, 0))  # CHW-RGB to HCW-BGR
+    return output
+
+
+def to_uint8(img):
+    return (img * 255.0).round().astype(np.uint8)
+
+
+def compare_outputs(ref, out, img_gt, border):
+    """Metrics of one image: output-vs-output and, with GT, the PSNR/SSIM-vs-GT deltas."""
+    ref_u8, out_u8 = to_uint8(ref), to_uint8(out)
+    metrics = {'max_abs': float(np.abs(ref - out).max()),
+               'psnr': util.calculate_psnr(ref_u8, out_u8, crop_border=border)}
+    if img_gt is not None:
+        gt = np.squeeze(to_uint8(img_gt))
+        metrics['gt_psnr_delta'] = (util.calculate_psnr(out_u8, gt, crop_border=border) -
+                                    util.calculate_psnr(ref_u8, gt, crop_border=border))
+        metrics['gt_ssim_delta'] = (util.calculate_ssim(out_u8, gt, crop_border=border) -
+                                    util.calculate_ssim(ref_u8, gt, crop_border=border))
+    return metrics
+
+
+def check_config(name, args, device):
+    """Run the reference and every candidate mode for one configuration.
+
+    Returns:
+        dict: mode -> list of per-image metrics.
+    """
+    margs = model_args(name)
+    folder_gt, folder_lq = TESTSETS[margs.task]
+    margs.folder_gt = folder_gt
+    margs.folder_lq = folder_lq.format(scale=margs.scale) if folder_lq else None
+    margs.model_path = args.model_path
+    margs.mode_tile, margs.tile_overlap = args.mode_tile, args.tile_overlap
+    torch.manual_seed(args.seed)
+    model = define_model(margs)
+    model.eval()
+    model = model.to(device)
+    folder, _, border, window_size = setup(margs)
+
+    forwards = {mode: MODES[mode][0](model, margs, window_size) for mode in args.modes}
+    references = {mode: MODES[mode][2](model, margs, window_size) if MODES[mode][2] else model
+                  for mode in args.modes}
+    paths = sorted(glob.glob(os.path.join(folder, '*')))
+    if args.max_images > 0:
+        paths = paths[:args.max_images]
+
+    metrics = {mode: [] for mode in args.modes}
+    for path in paths:
+        imgname, img_lq, img_gt = get_image_pair(margs, path)  # image to HWC-BGR, float32
+        img_lq, img_gt = center_crop(img_lq, img_gt, args.crop, margs.scale)
+        img_lq = np.transpose(img_lq if img_lq.shape[2] == 1 else img_lq[:, :, [2, 1, 0]], (2, 0, 1))
+        img_lq = torch.from_numpy(img_lq).float().unsqueeze(0).to(device)
+        if img_gt is not None:
+            h, w = img_lq.shape[2] * margs.scale, img_lq.shape[3] * margs.scale
+            img_gt = img_gt[:h, :w, ...]
+
+        refs = {}
+        for mode, forward in forwards.items():
+            reference = references[mode]
+            if reference not in refs:
+                refs[reference] = run(reference, img_lq, window_size, margs.scale)
+            ref = refs[reference]
+            out = run(forward, img_lq, window_size, margs.scale)
+            m = compare_outputs(ref, out, img_gt, border)
+            m['image'] = imgname
+            metrics[mode].append(m)
+    return metrics
+
+
+def summarize(metrics, tolerance):
+    """Worst case of one mode over the images of a config and whether it meets ``tolerance``."""
+    worst = {'max_abs': max(m['max_abs'] for m in metrics),
+             'psnr': min(m['psnr'] for m in metrics)}
+    gt = [m for m in metrics if 'gt_psnr_delta' in m]
+    if gt:
+        worst['gt_psnr_delta'] = max((m['gt_psnr_delta'] for m in gt), key=abs)
+        worst['gt_ssim_delta'] = max((m['gt_ssim_delta'] for m in gt), key=abs)
+
+    failed = []
+    if worst['max_abs'] > tolerance['max_abs']:
+        failed.append('max_abs')
+    if worst['psnr'] < tolerance['min_psnr']:
+        failed.append('psnr')
+    if gt and abs(worst['gt_psnr_delta']) > tolerance['max_gt_delta']:
+        failed.append('gt_psnr_delta')
+    return worst, failed
+
+
+def main():
+    args = get_args()
+    device = torch.device(args.device)
+
+    failures = 0
+    print('{:18s} {:14s} {:>10s} {:>9s} {:>10s} {:>10s}  {}'.format(
+        'config', 'mode', 'max abs', 'PSNR', 'dPSNR-GT', 'dSSIM-GT', 'status'))
+    for name in args.configs:
+        metrics = check_config(name, args, device)
+        for mode in args.modes:
+            if not metrics[mode]:
+                continue
+            worst, failed = summarize(metrics[mode], MODES[mode][1])
+            failures += bool(failed)
+            print('{:18s} {:14s} {:10.2e} {:9.2f} {:>10s} {:>10s}  {}'.format(
+                name, mode, worst['max_abs'], worst['psnr'],
+                '{:+.4f}'.format(worst['gt_psnr_delta']) if 'gt_psnr_delta' in worst else '-',
+                '{:+.5f}'.format(worst['gt_ssim_delta']) if 'gt_ssim_delta' in worst else '-',
+                'FAIL (' + ', '.join(failed) + ')' if failed else 'ok'))
+
+    print(f'\n{failures} failing config/mode pair(s)')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,6 +9,10 @@ import requests
 
 from models.network_swinir import SwinIR as net
 from utils import util_calculate_psnr_ssim as util
+from utils.util_autotune import apply_settings, load_settings, save_settings, user_tiling
+from utils.util_profiler import SwinIRProfiler
+from utils.util_streaming import (STREAM_EXTENSIONS, create_image_memmap, open_image_memmap, reflect_index,
+                                  value_range)
 
 
 def main():
@@ -27,8 +31,25 @@ def main():
     parser.add_argument('--folder_lq', type=str, default=None, help='input low-quality test image folder')
     parser.add_argument('--folder_gt', type=str, default=None, help='input ground-truth test image folder')
     parser.add_argument('--tile', type=int, default=None, help='Tile size, None for no tile during testing (testing as a whole)')
+    parser.add_argument('--tile_h', type=int, default=None, help='Tile height, overrides --tile (multiple of window_size)')
+    parser.add_argument('--tile_w', type=int, default=None, help='Tile width, overrides --tile (multiple of window_size)')
+    parser.add_argument('--strip', action='store_true',
+                        help='Tiles are full-width bands of --tile_h (or --tile) rows')
     parser.add_argument('--tile_overlap', type=int, default=32, help='Overlapping of different tiles')
+    parser.add_argument('--tile_batch', type=int, default=1, help='Number of tiles per forward pass')
+    parser.add_argument('--stream', action='store_true',
+                        help='Restore the .npy/.tif inputs tile by tile from disk and write the output band by '
+                             'band, so memory does not depend on the image height (needs a tile size; no metrics)')
+    parser.add_argument('--autotune', action='store_true',
+                        help='tune threads/tile for this host and model if no valid autotune profile exists')
+    parser.add_argument('--no_autotune_profile', action='store_true', help='ignore the per-host autotune profile')
+    parser.add_argument('--profile', action='store_true', help='time every SwinIR module with forward hooks')
+    parser.add_argument('--profile_trace', type=str, default=None, help='write the profile as a Chrome trace JSON')
     args = parser.parse_args()
+    if args.strip and args.tile is None and args.tile_h is None:
+        parser.error('--strip needs --tile_h or --tile')
+    if args.stream and args.tile is None and args.tile_h is None and args.tile_w is None:
+        parser.error('--stream needs --tile, --tile_h or --tile_w')
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     # set up model
@@ -44,10 +65,50 @@ def main():
     model = define_model(args)
     model.eval()
     model = model.to(device)
+    profiler = SwinIRProfiler(model).attach() if args.profile or args.profile_trace else None
 
     # setup folder and path
     folder, save_dir, border, window_size = setup(args)
     os.makedirs(save_dir, exist_ok=True)
+
+    # per-host threads/tile settings, see main_autotune_swinir.py
+    if not args.no_autotune_profile:
+        settings = load_settings(args)
+        if settings is None and args.autotune:
+            from main_autotune_swinir import autotune
+            if user_tiling(args):
+                # the profile holds a searched tiling, a fixed one is tuned for this run only
+                print('tiling set by the options: autotuning threads and tile batch only, not saved to the profile')
+                settings = autotune(model, args, window_size, device, fixed_tiling=True)
+                args.tile_batch = settings['tile_batch']
+            else:
+                settings = autotune(model, args, window_size, device)
+                save_settings(args, settings)
+        if settings is not None:
+            apply_settings(settings, args)
+            print('using autotuned settings: threads {} tile {} tile batch {}'.format(
+                settings['threads'], args.tile, args.tile_batch))
+
+    if args.stream:
+        # inputs as they are (lq images, e.g. real_sr), no ground truth
+        for idx, path in enumerate(sorted(glob.glob(os.path.join(args.folder_lq or folder, '*')))):
+            imgname, imgext = os.path.splitext(os.path.basename(path))
+            if imgext.lower() not in STREAM_EXTENSIONS:
+                continue
+            src = open_image_memmap(path)
+            if profiler is not None:
+                profiler.start_image(imgname)
+            out_path = f'{save_dir}/{imgname}_SwinIR{imgext}'
+            dst = create_image_memmap(out_path, (src.shape[0] * args.scale, src.shape[1] * args.scale) +
+                                      src.shape[2:], src.dtype)
+            with torch.no_grad():
+                test_streaming(src, dst, model, args, window_size, device)
+            dst.flush()
+            del dst
+            print('Testing {:d} {:20s} -> {}'.format(idx, imgname, out_path))
+        report_profile(profiler, args)
+        return
+
     test_results = OrderedDict()
     test_results['psnr'] = []
     test_results['ssim'] = []
@@ -64,6 +125,8 @@ def main():
         img_lq = torch.from_numpy(img_lq).float().unsqueeze(0).to(device)  # CHW-RGB to NCHW-RGB
 
         # inference
+        if profiler is not None:
+            profiler.start_image(imgname)
         with torch.no_grad():
             # pad input image to be a multiple of window_size
             _, _, h_old, w_old = img_lq.size()
@@ -71,6 +134,8 @@ def main():
             w_pad = (w_old // window_size + 1) * window_size - w_old
             img_lq = torch.cat([img_lq, torch.flip(img_lq, [2])], 2)[:, :, :h_old + h_pad, :]
             img_lq = torch.cat([img_lq, torch.flip(img_lq, [3])], 3)[:, :, :, :w_old + w_pad]
+            if tile_shape(args, h_old + h_pad, w_old + w_pad) is not None:
+                print_tiling(args, h_old + h_pad, w_old + w_pad)
             output = test(img_lq, model, args, window_size)
             output = output[..., :h_old * args.scale, :w_old * args.scale]
 
@@ -108,6 +173,8 @@ def main():
         else:
             print('Testing {:d} {:20s}'.format(idx, imgname))
 
+    report_profile(profiler, args)
+
     # summarize psnr/ssim
     if img_gt is not None:
         ave_psnr = sum(test_results['psnr']) / len(test_results['psnr'])
@@ -125,6 +192,18 @@ def main():
                 print('-- Average PSNRB_Y: {:.2f} dB'.format(ave_psnrb_y))
 
 
+def report_profile(profiler, args):
+    """Print the per-module profile and write its Chrome trace, for the streamed and the in-memory images."""
+    if profiler is None:
+        return
+    profiler.detach()
+    print('\n-- Per-module profile (all images):')
+    profiler.print_summary()
+    if args.profile_trace is not None:
+        profiler.export_chrome_trace(args.profile_trace)
+        print(f'-- Chrome trace written to {args.profile_trace}')
+
+
 def define_model(args):
     # 001 classical image sr
     if args.task == 'classical_sr':
@@ -186,6 +265,10 @@ def define_model(args):
                     mlp_ratio=2, upsampler='', resi_connection='1conv')
         param_key_g = 'params'
 
+    # no model_path: keep the random initialization (e.g. for benchmarking)
+    if args.model_path is None:
+        return model
+
     pretrained_model = torch.load(args.model_path)
     model.load_state_dict(pretrained_model[param_key_g] if param_key_g in pretrained_model.keys() else pretrained_model, strict=True)
 
@@ -275,35 +358,154 @@ def get_image_pair(args, path):
     return imgname, img_lq, img_gt
 
 
+def tile_shape(args, h, w):
+    """(tile height, tile width) of test() for an h x w (padded) input, or None to test it as a whole.
+
+    --tile_h/--tile_w override --tile per dimension, --strip makes the tiles full-width bands, and
+    each side is clamped to its own image dimension only.
+    """
+    tile_h = getattr(args, 'tile_h', None) or args.tile
+    tile_w = getattr(args, 'tile_w', None) or args.tile
+    if getattr(args, 'strip', False):
+        tile_w = w
+    if tile_h is None and tile_w is None:
+        return None
+    return min(tile_h or h, h), min(tile_w or w, w)
+
+
+def tile_index_list(size, tile, tile_overlap):
+    """Start of every tile along a dimension, the last one flush with its end."""
+    assert tile == size or tile > tile_overlap, "tile size should be larger than tile_overlap"
+    return list(range(0, size-tile, tile-tile_overlap)) + [size-tile]
+
+
+def redundant_fraction(h, w, tile_h, tile_w, tile_overlap):
+    """Pixels computed more than once by the tiles, as a fraction of the image area."""
+    tiles = len(tile_index_list(h, tile_h, tile_overlap)) * len(tile_index_list(w, tile_w, tile_overlap))
+    return (tiles * tile_h * tile_w - h * w) / (h * w)
+
+
+def print_tiling(args, h, w):
+    """Redundant compute of the tiling in use and of the square and strip baselines for an h x w input.
+
+    The square tiles have the side --tile, or the longer side of the tiles in use, clamped to min(h, w)
+    as test() did before rectangular tiles; the strips have the height of the tiles in use.
+    """
+    modes = OrderedDict()
+    shape = tile_shape(args, h, w)
+    modes['used'] = shape
+    modes['square'] = (min(args.tile or max(shape), h, w),) * 2
+    modes['strip'] = (shape[0], w)
+    print('tiling {}x{}: '.format(*shape) + ', '.join(
+        '{} {:.1%}'.format(mode, redundant_fraction(h, w, tile_h, tile_w, args.tile_overlap))
+        for mode, (tile_h, tile_w) in modes.items()) + ' redundant compute')
+
+
 def test(img_lq, model, args, window_size):
-    if args.tile is None:
+    b, c, h, w = img_lq.size()
+    shape = tile_shape(args, h, w)
+    if shape is None:
         # test the image as a whole
         output = model(img_lq)
     else:
         # test the image tile by tile
-        b, c, h, w = img_lq.size()
-        tile = min(args.tile, h, w)
-        assert tile % window_size == 0, "tile size should be a multiple of window_size"
+        tile_h, tile_w = shape
+        assert tile_h % window_size == 0 and tile_w % window_size == 0, \
+            "tile size should be a multiple of window_size"
         tile_overlap = args.tile_overlap
         sf = args.scale
 
-        stride = tile - tile_overlap
-        h_idx_list = list(range(0, h-tile, stride)) + [h-tile]
-        w_idx_list = list(range(0, w-tile, stride)) + [w-tile]
+        tile_batch = getattr(args, 'tile_batch', 1) or 1
+
+        h_idx_list = tile_index_list(h, tile_h, tile_overlap)
+        w_idx_list = tile_index_list(w, tile_w, tile_overlap)
         E = torch.zeros(b, c, h*sf, w*sf).type_as(img_lq)
         W = torch.zeros_like(E)
 
-        for h_idx in h_idx_list:
-            for w_idx in w_idx_list:
-                in_patch = img_lq[..., h_idx:h_idx+tile, w_idx:w_idx+tile]
-                out_patch = model(in_patch)
+        # run up to tile_batch tiles per forward pass
+        tile_idx_list = [(h_idx, w_idx) for h_idx in h_idx_list for w_idx in w_idx_list]
+        for i in range(0, len(tile_idx_list), tile_batch):
+            batch_idx_list = tile_idx_list[i:i+tile_batch]
+            in_patch = torch.cat([img_lq[..., h_idx:h_idx+tile_h, w_idx:w_idx+tile_w]
+                                  for h_idx, w_idx in batch_idx_list], 0)
+            out_patches = model(in_patch).split(b, 0)
+
+            for (h_idx, w_idx), out_patch in zip(batch_idx_list, out_patches):
                 out_patch_mask = torch.ones_like(out_patch)
 
-                E[..., h_idx*sf:(h_idx+tile)*sf, w_idx*sf:(w_idx+tile)*sf].add_(out_patch)
-                W[..., h_idx*sf:(h_idx+tile)*sf, w_idx*sf:(w_idx+tile)*sf].add_(out_patch_mask)
+                E[..., h_idx*sf:(h_idx+tile_h)*sf, w_idx*sf:(w_idx+tile_w)*sf].add_(out_patch)
+                W[..., h_idx*sf:(h_idx+tile_h)*sf, w_idx*sf:(w_idx+tile_w)*sf].add_(out_patch_mask)
         output = E.div_(W)
 
     return output
 
+
+def test_streaming(src, dst, model, args, window_size, device):
+    """Tiled test() of an on-disk image, reading input rows on demand and writing output rows as they are final.
+
+    src and dst are HW or HWC arrays (e.g. memory maps from utils.util_streaming) with the same
+    dtype and channel order; dst is args.scale times larger. The input is padded by reflection as
+    in main() and the tiles, their overlap and the averaging are those of test(), so the output
+    is the same. Tiles are run one row of tiles at a time: only the input rows of that row of
+    tiles and an accumulator of its output rows are in memory, and output rows no later tile
+    overlaps are written to dst. The tile weights are not stored, the number of tiles covering a
+    pixel is the product of the counts of its row and column.
+    """
+    h_old, w_old = src.shape[:2]
+    c = src.shape[2] if src.ndim == 3 else 1
+    sf = args.scale
+    white = value_range(src.dtype)
+    tile_batch = getattr(args, 'tile_batch', 1) or 1
+
+    # pad input image to be a multiple of window_size, as main()
+    h = (h_old // window_size + 1) * window_size
+    w = (w_old // window_size + 1) * window_size
+    rows, cols = reflect_index(h, h_old), reflect_index(w, w_old)
+
+    tile_h, tile_w = tile_shape(args, h, w)
+    assert tile_h % window_size == 0 and tile_w % window_size == 0, "tile size should be a multiple of window_size"
+    h_idx_list = tile_index_list(h, tile_h, args.tile_overlap)
+    w_idx_list = tile_index_list(w, tile_w, args.tile_overlap)
+    print_tiling(args, h, w)
+
+    # tiles covering every output row and column; W of test() is their outer product
+    count_h, count_w = np.zeros(h*sf, np.float32), np.zeros(w*sf, np.float32)
+    for h_idx in h_idx_list:
+        count_h[h_idx*sf:(h_idx+tile_h)*sf] += 1
+    for w_idx in w_idx_list:
+        count_w[w_idx*sf:(w_idx+tile_w)*sf] += 1
+    count_w = torch.from_numpy(count_w[:w_old*sf]).to(device)
+
+    def write(E, top, bottom):
+        # output rows [top, bottom) from the accumulator starting at row top, cropped to the image
+        bottom = min(bottom, h_old*sf)
+        if bottom <= top:
+            return
+        weight = torch.from_numpy(count_h[top:bottom]).to(device)[:, None] * count_w
+        out = E[:, :bottom-top, :w_old*sf].div(weight).clamp_(0, 1).mul_(white)
+        out = out.round_() if np.issubdtype(dst.dtype, np.integer) else out
+        out = out.permute(1, 2, 0).cpu().numpy().astype(dst.dtype)
+        dst[top:bottom] = out if dst.ndim == 3 else out[..., 0]
+
+    cols_t = torch.from_numpy(cols).to(device)
+    E = torch.zeros(c, tile_h*sf, w*sf, device=device)
+    top = 0
+    for h_idx in h_idx_list:
+        # rows above this row of tiles are final: write them and move the accumulator down
+        shift = h_idx*sf - top
+        if shift:
+            write(E, top, h_idx*sf)
+            E = torch.cat([E[:, shift:], E.new_zeros(c, shift, w*sf)], 1)
+            top = h_idx*sf
+
+        band = np.asarray(src[rows[h_idx:h_idx+tile_h]], dtype=np.float32) / white
+        band = torch.from_numpy(band.reshape(tile_h, w_old, c)).permute(2, 0, 1).to(device)
+        for i in range(0, len(w_idx_list), tile_batch):
+            batch_idx_list = w_idx_list[i:i+tile_batch]
+            in_patch = torch.stack([band[:, :, cols_t[w_idx:w_idx+tile_w]] for w_idx in batch_idx_list], 0)
+            for w_idx, out_patch in zip(batch_idx_list, model(in_patch)):
+                E[:, :, w_idx*sf:(w_idx+tile_w)*sf].add_(out_patch)
+    write(E, top, h*sf)
+
 if __name__ == '__main__':
     main()
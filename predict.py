@@ -9,7 +9,8 @@ import glob
 import torch
 from collections import OrderedDict
 import numpy as np
-from main_test_swinir import define_model, setup, get_image_pair
+from main_test_swinir import define_model, setup, get_image_pair, test
+from utils.util_autotune import apply_settings, load_settings
 
 
 class Predictor(cog.Predictor):
@@ -53,6 +54,9 @@ class Predictor(cog.Predictor):
                             default=self.model_zoo['real_sr'][4])
         parser.add_argument('--folder_lq', type=str, default=None, help='input low-quality test image folder')
         parser.add_argument('--folder_gt', type=str, default=None, help='input ground-truth test image folder')
+        parser.add_argument('--tile', type=int, default=None, help='Tile size, None for no tile during testing')
+        parser.add_argument('--tile_overlap', type=int, default=32, help='Overlapping of different tiles')
+        parser.add_argument('--tile_batch', type=int, default=1, help='Number of tiles per forward pass')
 
         self.args = parser.parse_args('')
 
@@ -109,6 +113,12 @@ class Predictor(cog.Predictor):
             # setup folder and path
             folder, save_dir, border, window_size = setup(self.args)
             os.makedirs(save_dir, exist_ok=True)
+
+            # per-host threads/tile settings from main_autotune_swinir.py, if tuned for this model
+            self.args.tile, self.args.tile_batch = None, 1
+            settings = load_settings(self.args)
+            if settings is not None:
+                apply_settings(settings, self.args)
             test_results = OrderedDict()
             test_results['psnr'] = []
             test_results['ssim'] = []
@@ -133,7 +143,7 @@ class Predictor(cog.Predictor):
                     w_pad = (w_old // window_size + 1) * window_size - w_old
                     img_lq = torch.cat([img_lq, torch.flip(img_lq, [2])], 2)[:, :, :h_old + h_pad, :]
                     img_lq = torch.cat([img_lq, torch.flip(img_lq, [3])], 3)[:, :, :, :w_old + w_pad]
-                    output = model(img_lq)
+                    output = test(img_lq, model, self.args, window_size)
                     output = output[..., :h_old * self.args.scale, :w_old * self.args.scale]
 
                 # save image
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+
+
+# bump when a stage implementation changes its output, to invalidate old entries
+CACHE_VERSION = 1
+
+
+def file_key(path, chunk_size=2 ** 20):
+    """sha256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stage_key(upstream_key, name, params):
+    """Key of a stage output: hash of the upstream key, the stage name and its parameters."""
+    key = json.dumps([CACHE_VERSION, upstream_key, name, params], sort_keys=True, default=repr)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class StageCache(object):
+    """Content-addressed on-disk cache of stage outputs (.npy files) with LRU eviction.
+
+    Entries are keyed by stage_key chains, so an output is reused whenever the input file and
+    every stage up to it are unchanged. Reading an entry refreshes its modification time, and
+    when the cache grows beyond max_bytes the least recently used entries are deleted until it
+    is below 90% of max_bytes. Writes go through a temporary file and os.replace, so several
+    processes can share a cache directory.
+
+    Args:
+        cache_dir (str): Directory of the entries.
+        max_bytes (int): Size bound. Default: 10 GB.
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+        self._size = sum(size for _, _, size in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue  # evicted by another process
+                entries.append((stat.st_mtime, name, stat.st_size))
+        return entries
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        """Cached array of key, or None."""
+        path = self._path(key)
+        try:
+            array = np.load(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return array
+
+    def put(self, key, array):
+        path = self._path(key)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+        self.stats['writes'] += 1
+        self._size += os.path.getsize(path)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache is below 90% of max_bytes."""
+        entries = sorted(self._entries())
+        self._size = sum(size for _, _, size in entries)
+        for _, name, size in entries:
+            if self._size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                self.stats['evictions'] += 1
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+    def pop_stats(self):
+        """Statistics since the last call (or since creation), then reset them."""
+        stats = self.stats
+        self.stats = dict.fromkeys(stats, 0)
+        return stats
+
+
+def print_cache_stats(stats):
+    lookups = stats['hits'] + stats['misses']
+    print('Cache: {} hits, {} misses ({:.0%} hit rate), {} writes, {} evictions'.format(
+        stats['hits'], stats['misses'], stats['hits'] / lookups if lookups else 0., stats['writes'],
+        stats['evictions']))
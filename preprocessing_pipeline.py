@@ -0,0 +1,170 @@
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import image_preprocessing as ip
+from preprocessing_cache import stage_key
+from ColumnNormalization import (apply_column_gamma_profile_array, columnwise_normalization_array,
+                                 remove_column_noise_gamma_array)
+
+
+# ndarray cores the pipeline can chain, by the name of their PIL factory; each is called as
+# stage(src, **params, dst=dst). mask_combine takes two images and is not a chain stage.
+STAGES = {
+    'denoise_gaussianBlur': ip.denoise_gaussianBlur_array,
+    'denoise_fastN1MeansDenoising': ip.denoise_fastN1MeansDenoising_array,
+    'denoise_medianBlur': ip.denoise_medianBlur_array,
+    'denoise_bilateralFilter': ip.denoise_bilateralFilter_array,
+    'edge_unsharpMask': ip.edge_unsharpMask_array,
+    'edge_grayscale_erosion': ip.edge_grayscale_erosion_array,
+    'edge_mask_laplacian': ip.edge_mask_laplacian_array,
+    'edge_mask_binary_erosion': ip.edge_mask_binary_erosion_array,
+    'edge_mask_sobel_filter': ip.edge_mask_sobel_filter_array,
+    'edge_mask_scharr_filter': ip.edge_mask_scharr_filter_array,
+    'contrast_clahe': ip.contrast_clahe_array,
+    'contrast_gamma_correction': ip.contrast_gamma_correction_array,
+    'misc_convert_binary': ip.misc_convert_binary_array,
+    'misc_normalise_img': ip.misc_normalise_img_array,
+    'columnwise_normalization': columnwise_normalization_array,
+    'remove_column_noise_gamma': lambda src, dst=None, **params: remove_column_noise_gamma_array(src, **params),
+    'apply_column_gamma_profile': apply_column_gamma_profile_array,
+}
+
+# per-pixel maps of uint8 images with the LUT of their stage; misc_normalise_img depends on the
+# value range of its input and gets it as the two leading arguments
+POINT_OPS = {
+    'contrast_gamma_correction': ip.contrast_gamma_correction_lut,
+    'misc_convert_binary': ip.misc_convert_binary_lut,
+    'misc_normalise_img': ip.misc_normalise_img_lut,
+}
+
+
+def fused_point_ops(src, ops, dst=None):
+    """Apply a run of POINT_OPS stages to a uint8 image as one composed LUT in a single pass."""
+    lut = None
+    present = None
+    for name, params in ops:
+        if name == 'misc_normalise_img':
+            if lut is None:
+                img_min, img_max, _, _ = cv2.minMaxLoc(src)
+            else:
+                # value range after the LUTs so far, from the values present in the input
+                if present is None:
+                    present = np.flatnonzero(cv2.calcHist([src], [0], None, [256], [0, 256]))
+                mapped = lut[present]
+                img_min, img_max = mapped.min(), mapped.max()
+            op_lut = POINT_OPS[name](int(img_min), int(img_max), **params)
+        else:
+            op_lut = POINT_OPS[name](**params)
+        lut = op_lut if lut is None else op_lut[lut]
+    return cv2.LUT(src, lut, dst)
+
+
+class Pipeline(object):
+    """Chain of preprocessing stages on one 2D uint8 ndarray, PIL only at the boundaries.
+
+    Stages are given as names of STAGES or (name, params) pairs, e.g.
+    Pipeline([('remove_column_noise_gamma', {'steps': 100, 'engine': 'lut'}), ('contrast_clahe', {'clipLimit': 1.5})]).
+    Two output buffers per image shape are reused between stages and calls: every stage writes
+    into the buffer its input is not in (OpenCV stages that accept dst do so without allocating).
+    With fuse=True consecutive POINT_OPS stages run as one fused stage (one cv2.LUT pass over
+    uint8 images, see fused_point_ops). The wall time of every (fused) stage is recorded in
+    timings, those of the last call in last_timings.
+
+    With a preprocessing_cache.StageCache and the key of the input image, the output of every
+    (fused) stage is cached and a call only recomputes the stages after the last cached one.
+
+    Args:
+        stages (list): Stage names or (name, params) pairs, applied in order.
+        fuse (bool): Fuse runs of point operations. Default: True.
+    """
+
+    def __init__(self, stages, fuse=True):
+        self.stages = []
+        for stage in stages:
+            name, params = (stage, {}) if isinstance(stage, str) else stage
+            if name not in STAGES:
+                raise ValueError(f'Unknown preprocessing stage {name}, use one of {", ".join(STAGES)}')
+            self.stages.append((name, dict(params)))
+
+        # plan: (label, [indices of the stages it runs])
+        self.plan = []
+        for index, (name, _) in enumerate(self.stages):
+            previous = self.plan[-1][1] if self.plan else []
+            if fuse and name in POINT_OPS and previous and self.stages[previous[-1]][0] in POINT_OPS:
+                previous.append(index)
+            else:
+                self.plan.append((None, [index]))
+        self.plan = [(self.label(indices), indices) for _, indices in self.plan]
+        self.timings = {label: [] for label, _ in self.plan}
+        self.last_timings = {}
+        self._buffers = {}
+
+    def label(self, indices):
+        return '{}:{}'.format('-'.join(str(i) for i in sorted({indices[0], indices[-1]})),
+                              '+'.join(self.stages[i][0] for i in indices))
+
+    def _buffer_pair(self, shape):
+        if shape not in self._buffers:
+            self._buffers[shape] = (np.empty(shape, dtype=np.uint8), np.empty(shape, dtype=np.uint8))
+        return self._buffers[shape]
+
+    def step_keys(self, key):
+        """Cache key of the output of every step of the plan, for an input with key."""
+        keys = []
+        for _, indices in self.plan:
+            for i in indices:
+                key = stage_key(key, *self.stages[i])
+            keys.append(key)
+        return keys
+
+    def run(self, img_np, cache=None, key=None):
+        """Apply all stages to an ndarray.
+
+        The result can be one of the reused buffers, so it is only valid until the next call.
+        """
+        current, first_step = img_np, 0
+        if cache is not None:
+            keys = self.step_keys(key)
+            for step in reversed(range(len(self.plan))):
+                cached = cache.get(keys[step])
+                if cached is not None:
+                    current, first_step = cached, step + 1
+                    break
+
+        buffers = self._buffer_pair(img_np.shape)
+        self.last_timings = {}
+        for step in range(first_step, len(self.plan)):
+            label, indices = self.plan[step]
+            dst = buffers[1] if current is buffers[0] else buffers[0]
+            start = time.perf_counter()
+            if len(indices) > 1 and current.dtype == np.uint8:
+                current = fused_point_ops(current, [self.stages[i] for i in indices], dst)
+            else:
+                for i in indices:
+                    name, params = self.stages[i]
+                    current = STAGES[name](current, dst=dst, **params)
+                    dst = buffers[1] if current is buffers[0] else buffers[0]
+            self.last_timings[label] = time.perf_counter() - start
+            self.timings[label].append(self.last_timings[label])
+            if cache is not None:
+                cache.put(keys[step], current)
+        return current
+
+    def __call__(self, img, cache=None, key=None):
+        output = self.run(np.asarray(img), cache, key)
+        # Image.fromarray can share the array memory, never hand out a reused buffer
+        if any(output is buffer for buffer in self._buffers.get(output.shape, ())):
+            output = output.copy()
+        return Image.fromarray(output)
+
+    def summary(self):
+        """Mean and total seconds per stage over all calls, in stage order."""
+        return [(label, float(np.mean(times)) if times else 0., float(np.sum(times)))
+                for label, times in self.timings.items()]
+
+    def print_timings(self):
+        for label, mean, total in self.summary():
+            print(f'{label:40s} {mean * 1e3:9.2f} ms/image {total:9.2f} s total')
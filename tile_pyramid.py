@@ -0,0 +1,220 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import sys
+import threading
+import traceback
+from collections import OrderedDict
+
+from PIL import Image
+
+
+# bump when the layout of a pyramid changes, to rebuild old ones
+PYRAMID_VERSION = 1
+DEFAULT_TILE_SIZE = 256
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Build the tile pyramids of result folders for DisplayImages.py')
+    parser.add_argument('--imgs', nargs='+', type=str, help='Result folders')
+    parser.add_argument('--tile_size', type=int, default=DEFAULT_TILE_SIZE, help='Tile width and height')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--force', action='store_true', help='Also rebuild the pyramids that are up to date')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def tiles_dir(results_dir):
+    """Folder of the pyramids of a results folder: next to it, with a _tiles suffix."""
+    return os.path.normpath(results_dir) + '_tiles'
+
+
+def pyramid_dir(image_path):
+    """Folder of the pyramid of an image."""
+    folder, name = os.path.split(image_path)
+    return os.path.join(tiles_dir(folder), name)
+
+
+def _source_stamp(image_path):
+    stat = os.stat(image_path)
+    return {'mtime': stat.st_mtime, 'bytes': stat.st_size}
+
+
+def read_meta(image_path):
+    """meta.json of the pyramid of an image, or None if it is missing or older than the image."""
+    try:
+        with open(os.path.join(pyramid_dir(image_path), 'meta.json')) as f:
+            meta = json.load(f)
+        stamp = _source_stamp(image_path)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != PYRAMID_VERSION or meta.get('source') != stamp:
+        return None
+    return meta
+
+
+def build_pyramid(image_path, tile_size=DEFAULT_TILE_SIZE):
+    """Write the tile pyramid of an image: <level>/<row>_<col>.png tiles and meta.json.
+
+    Level 0 is the image and level n is level n - 1 halved with Image.reduce (as the viewer's
+    in-memory pyramid), down to a level that fits in one tile. meta.json is written last, so a
+    pyramid is only used once complete.
+    """
+    stamp = _source_stamp(image_path)
+    folder = pyramid_dir(image_path)
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+
+    img = Image.open(image_path)
+    img.load()
+    levels = []
+    while True:
+        os.makedirs(os.path.join(folder, str(len(levels))))
+        for row in range(math.ceil(img.height / tile_size)):
+            for col in range(math.ceil(img.width / tile_size)):
+                box = (col * tile_size, row * tile_size, min(img.width, (col + 1) * tile_size),
+                       min(img.height, (row + 1) * tile_size))
+                img.crop(box).save(os.path.join(folder, str(len(levels)), f'{row}_{col}.png'))
+        levels.append([img.width, img.height])
+        if max(img.size) <= tile_size:
+            break
+        try:
+            img = img.reduce(2)
+        except ValueError:  # modes reduce does not support, e.g. P
+            img = img.resize((max(1, img.width // 2), max(1, img.height // 2)), Image.NEAREST)
+
+    meta = {'version': PYRAMID_VERSION, 'source': stamp, 'mode': img.mode, 'tile_size': tile_size,
+            'levels': levels}
+    with open(os.path.join(folder, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(folder, 'meta.json.tmp'), os.path.join(folder, 'meta.json'))
+    return meta
+
+
+def _build_task(task):
+    """build_pyramid for a pool; returns (image path, error) and never raises."""
+    image_path, tile_size = task
+    try:
+        build_pyramid(image_path, tile_size)
+    except Exception as e:
+        return image_path, ''.join(traceback.format_exception_only(type(e), e)).strip()
+    return image_path, None
+
+
+def build_pyramids(results_dirs, tile_size=DEFAULT_TILE_SIZE, workers=1, force=False):
+    """Build the missing or outdated pyramids of every image of the results folders.
+
+    Returns:
+        tuple: (built image paths, up to date image paths, {failed image path: error}).
+    """
+    extensions = Image.registered_extensions()
+    todo, up_to_date = [], []
+    for results_dir in results_dirs:
+        for name in sorted(os.listdir(results_dir)):
+            path = os.path.join(results_dir, name)
+            if os.path.splitext(name)[1].lower() not in extensions:
+                continue
+            meta = None if force else read_meta(path)
+            if meta is not None and meta['tile_size'] == tile_size:
+                up_to_date.append(path)
+            else:
+                todo.append(path)
+
+    tasks = [(path, tile_size) for path in todo]
+    if workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = list(pool.imap_unordered(_build_task, tasks))
+    else:
+        results = [_build_task(task) for task in tasks]
+    failed = {path: error for path, error in results if error is not None}
+    return [path for path in todo if path not in failed], up_to_date, failed
+
+
+class TileCache(object):
+    """LRU cache of decoded tiles, shared by the open pyramids, bounded by the decoded size."""
+
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            if path in self._tiles:
+                self._tiles.move_to_end(path)
+                return self._tiles[path]
+        tile = Image.open(path)
+        tile.load()
+        with self._lock:
+            if path not in self._tiles:
+                self._tiles[path] = tile
+                self.size += tile.width * tile.height * len(tile.getbands())
+            while self.size > self.max_bytes and len(self._tiles) > 1:
+                _, dropped = self._tiles.popitem(last=False)
+                self.size -= dropped.width * dropped.height * len(dropped.getbands())
+        return tile
+
+
+class TilePyramid(object):
+    """Tile pyramid of an image on disk, read only for the tiles under a requested region.
+
+    Args:
+        image_path (str): The image of the pyramid.
+        meta (dict): Its read_meta.
+        cache (TileCache): Cache of the decoded tiles.
+    """
+
+    def __init__(self, image_path, meta, cache):
+        self.folder = pyramid_dir(image_path)
+        self.meta = meta
+        self.cache = cache
+        self.width, self.height = meta['levels'][0]
+        self.mode = meta['mode']
+        self.levels = len(meta['levels'])
+
+    @classmethod
+    def open(cls, image_path, cache):
+        """The pyramid of an image, or None if it has none or it is outdated."""
+        meta = read_meta(image_path)
+        return cls(image_path, meta, cache) if meta is not None else None
+
+    def level_size(self, level):
+        return tuple(self.meta['levels'][level])
+
+    def resize(self, level, size, box):
+        """Same as level.resize(size, box=box), reading only the tiles under box."""
+        tile_size = self.meta['tile_size']
+        width, height = self.level_size(level)
+        # resampling reads a few pixels around the box (bicubic support, the level downscales by less than 2)
+        margin = 4
+        col0, row0 = max(0, int((box[0] - margin) // tile_size)), max(0, int((box[1] - margin) // tile_size))
+        col1 = min(math.ceil(width / tile_size), int((box[2] + margin) // tile_size) + 1)
+        row1 = min(math.ceil(height / tile_size), int((box[3] + margin) // tile_size) + 1)
+
+        x0, y0 = col0 * tile_size, row0 * tile_size
+        mosaic = Image.new(self.mode, (min(width, col1 * tile_size) - x0, min(height, row1 * tile_size) - y0))
+        for row in range(row0, row1):
+            for col in range(col0, col1):
+                tile = self.cache.get(os.path.join(self.folder, str(level), f'{row}_{col}.png'))
+                mosaic.paste(tile, (col * tile_size - x0, row * tile_size - y0))
+        return mosaic.resize(size, box=(box[0] - x0, box[1] - y0, box[2] - x0, box[3] - y0))
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    built, up_to_date, failed = build_pyramids(args.imgs, args.tile_size, args.workers, args.force)
+    print(f"{len(built)} pyramids built, {len(up_to_date)} up to date, in: "
+          + ", ".join(tiles_dir(folder) for folder in args.imgs))
+
+    if failed:
+        for path, error in failed.items():
+            print(f"Failed: {path}: {error}")
+        sys.exit(1)
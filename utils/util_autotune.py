@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+
+import cv2
+import torch
+
+from utils.util_benchmark import host_fingerprint, host_info
+
+
+DEFAULT_PROFILE_DIR = os.environ.get('SWINIR_AUTOTUNE_DIR', 'experiments/autotune')
+
+
+def profile_path(profile_dir=DEFAULT_PROFILE_DIR, fingerprint=None):
+    """Per-host autotune profile: <profile_dir>/<host fingerprint>.json"""
+    return os.path.join(profile_dir, f'{fingerprint or host_fingerprint()}.json')
+
+
+def model_key(args):
+    """What a profile entry is keyed on: the architecture options of define_model and the weights file.
+
+    The weights are identified by name, size and modification time, so replacing them or
+    switching tasks invalidates the tuned settings.
+    """
+    key = {'task': args.task, 'scale': args.scale, 'large_model': getattr(args, 'large_model', False),
+           'training_patch_size': getattr(args, 'training_patch_size', None)}
+    model_path = getattr(args, 'model_path', None)
+    if model_path is not None and os.path.exists(model_path):
+        stat = os.stat(model_path)
+        key['model'] = (os.path.basename(model_path), stat.st_size, int(stat.st_mtime))
+    else:
+        key['model'] = None
+    return key
+
+
+def model_signature(args):
+    """Identify the model a profile entry was tuned for, see model_key."""
+    return hashlib.sha1(json.dumps(model_key(args), sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+def load_profile(profile_dir=DEFAULT_PROFILE_DIR, verbose=False):
+    path = profile_path(profile_dir)
+    if not os.path.exists(path):
+        if verbose and os.path.isdir(profile_dir) and any(f.endswith('.json') for f in os.listdir(profile_dir)):
+            print(f'autotune profiles in {profile_dir} ignored: they were tuned on other hosts '
+                  f'(host fingerprint {host_fingerprint()} changed)')
+        return None
+    with open(path) as f:
+        profile = json.load(f)
+    if profile.get('fingerprint') != host_fingerprint():
+        if verbose:
+            print(f'autotune profile {path} ignored: host fingerprint changed')
+        return None
+    return profile
+
+
+def load_settings(args, profile_dir=DEFAULT_PROFILE_DIR, verbose=True):
+    """Tuned settings for this host and model, or None if they have to be (re-)tuned.
+
+    With verbose, says why an existing profile is not used.
+    """
+    profile = load_profile(profile_dir, verbose)
+    if profile is None:
+        return None
+    settings = profile['entries'].get(model_signature(args))
+    if settings is None and verbose and profile['entries']:
+        key = model_key(args)
+        same_model = [entry for entry in profile['entries'].values()
+                      if {k: v for k, v in entry.get('model_key', {}).items() if k != 'model'} ==
+                      {k: v for k, v in key.items() if k != 'model'}]
+        reason = 'the weights changed' if same_model else 'it has no entry for this task/model'
+        print(f'autotune profile {profile_path(profile_dir)} ignored for {key["task"]} x{key["scale"]} '
+              f'({key["model"][0] if key["model"] else "random weights"}): {reason}')
+    return settings
+
+
+def save_settings(args, settings, profile_dir=DEFAULT_PROFILE_DIR):
+    info = host_info()
+    profile = load_profile(profile_dir) or {'fingerprint': host_fingerprint(info), 'host': info, 'entries': {}}
+    profile['entries'][model_signature(args)] = dict(settings, model_key=model_key(args))
+    os.makedirs(profile_dir, exist_ok=True)
+    path = profile_path(profile_dir, profile['fingerprint'])
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=2)
+    return path
+
+
+def user_tiling(args):
+    """Whether the options fix the tiling (--tile, --tile_h, --tile_w or --strip), which autotuning then keeps."""
+    return any(getattr(args, name, None) for name in ('tile', 'tile_h', 'tile_w', 'strip'))
+
+
+def apply_settings(settings, args=None):
+    """Apply tuned thread counts and, unless a tiling is already set on ``args``, the tile options.
+
+    Args:
+        settings (dict): A profile entry (threads, interop_threads, cv2_threads, tile, tile_batch).
+        args (Namespace | None): Options of main_test_swinir.test to fill in.
+    """
+    torch.set_num_threads(settings['threads'])
+    try:
+        torch.set_num_interop_threads(settings['interop_threads'])
+    except RuntimeError:
+        # can only be set once per process, before any inter-op parallel work started
+        pass
+    cv2.setNumThreads(settings['cv2_threads'])
+
+    if args is not None and not user_tiling(args):
+        args.tile = settings['tile']
+        args.tile_batch = settings['tile_batch']
@@ -0,0 +1,213 @@
+import ctypes
+import hashlib
+import json
+import os
+import platform
+import threading
+import time
+
+import torch
+
+
+def cpu_model_name():
+    """CPU model string, read from /proc/cpuinfo on Linux."""
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def host_info():
+    """Describe the host a benchmark ran on.
+
+    Returns:
+        dict: cpu model, core count, torch version and, if present, the CUDA device name.
+    """
+    info = {
+        'cpu': cpu_model_name(),
+        'cores': os.cpu_count(),
+        'torch': torch.__version__,
+        'cuda': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+    }
+    return info
+
+
+def host_fingerprint(info=None):
+    """Short stable id of a host, derived from :func:`host_info`."""
+    info = host_info() if info is None else info
+    key = json.dumps({k: info[k] for k in ('cpu', 'cores', 'torch', 'cuda')}, sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+
+def rss_bytes():
+    """Resident set size of this process in bytes (Linux), or 0 if unavailable."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def release_free_memory():
+    """Return freed heap memory to the OS (glibc only) so RSS peaks of later runs are not hidden."""
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class PeakMemoryMonitor(object):
+    """Measure the peak memory of a block of code.
+
+    On CUDA this is ``torch.cuda.max_memory_allocated`` above the memory allocated when the
+    block was entered. On CPU the process RSS is sampled from a background thread, as torch
+    exposes no allocator statistics for host memory; the result is the peak RSS above the
+    RSS when the block was entered.
+
+    Args:
+        device (torch.device): Device the measured code runs on.
+        interval (float): RSS sampling interval in seconds. Default: 0.002.
+    """
+
+    def __init__(self, device, interval=0.002):
+        self.device = torch.device(device)
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self._peak_rss = max(self._peak_rss, rss_bytes())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self._base = torch.cuda.memory_allocated(self.device)
+        else:
+            release_free_memory()
+            self._base = self._peak_rss = rss_bytes()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            self.peak_bytes = torch.cuda.max_memory_allocated(self.device) - self._base
+        else:
+            self._stop.set()
+            self._thread.join()
+            self._peak_rss = max(self._peak_rss, rss_bytes())
+            self.peak_bytes = self._peak_rss - self._base
+
+
+def save_results(path, results, info=None):
+    """Write benchmark results together with the host description as JSON."""
+    info = host_info() if info is None else info
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'host': info, 'fingerprint': host_fingerprint(info),
+                   'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}, f, indent=2)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def baseline_path(baseline_dir, fingerprint):
+    """Location of the stored baseline for a host fingerprint."""
+    return os.path.join(baseline_dir, f'{fingerprint}.json')
+
+
+def result_key(result):
+    """Identify a benchmark setting independently of the measured values."""
+    return (result['config'], result['size'], result['batch'], result['tile'], result['threads'], result['device'])
+
+
+def relative_noise(values):
+    """Coefficient of variation of repeated measurements (0 for a single run)."""
+    n = len(values)
+    if n < 2:
+        return 0.
+    mean = sum(values) / n
+    if mean <= 0:
+        return 0.
+    var = sum((t - mean) ** 2 for t in values) / (n - 1)
+    return var ** 0.5 / mean
+
+
+def compare_results(base, new, threshold=0.05, noise_sigmas=3., mem_threshold=0.10, mem_floor=32 * 2 ** 20):
+    """Compare two benchmark result lists setting by setting.
+
+    Latency and throughput use a relative threshold widened by the run-to-run noise:
+    ``max(threshold, noise_sigmas * sqrt(cv_base ** 2 + cv_new ** 2))``, where ``cv`` is the
+    coefficient of variation of the repeated latencies. Peak memory uses the same noise model
+    on the per-run peaks (results without them count as noiseless) with ``mem_threshold``, and
+    only regresses when it also grows by more than ``mem_floor`` bytes; smaller growths are
+    reported as warnings, as CPU RSS peaks of small runs are dominated by allocator noise.
+
+    Args:
+        base (list[dict]): Baseline results (``results`` of a saved benchmark file).
+        new (list[dict]): Candidate results.
+        threshold (float): Minimum relative change considered significant. Default: 0.05.
+        noise_sigmas (float): Noise multiplier for the adaptive thresholds. Default: 3.
+        mem_threshold (float): Minimum relative peak-memory change considered significant. Default: 0.10.
+        mem_floor (int): Absolute peak-memory growth below which it is only a warning, in bytes.
+            Default: 32 MB.
+
+    Returns:
+        list[dict]: One row per setting present in both lists with the deltas, the thresholds, the
+            regressed and warned metrics and a status of 'regression', 'warning', 'improvement' or 'ok'.
+    """
+    base_by_key = {result_key(r): r for r in base}
+    rows = []
+    for n in new:
+        key = result_key(n)
+        if key not in base_by_key:
+            continue
+        b = base_by_key[key]
+        noise = noise_sigmas * (relative_noise(b['latencies']) ** 2 + relative_noise(n['latencies']) ** 2) ** 0.5
+        limit = max(threshold, noise)
+        mem_noise = noise_sigmas * (relative_noise(b.get('peak_mems', [])) ** 2 +
+                                    relative_noise(n.get('peak_mems', [])) ** 2) ** 0.5
+        mem_limit = max(mem_threshold, mem_noise)
+
+        latency_delta = n['latency'] / b['latency'] - 1
+        throughput_delta = n['throughput_mpix_s'] / b['throughput_mpix_s'] - 1
+        mem_diff = n['peak_mem_bytes'] - b['peak_mem_bytes']
+        if b['peak_mem_bytes'] > 0:
+            mem_delta = mem_diff / b['peak_mem_bytes']
+        else:
+            mem_delta = float('inf') if mem_diff > 0 else 0.
+
+        regressed, warned = [], []
+        if latency_delta > limit:
+            regressed.append('latency')
+        if throughput_delta < -limit:
+            regressed.append('throughput')
+        if mem_delta > mem_limit:
+            (regressed if mem_diff > mem_floor else warned).append('peak_mem')
+
+        if regressed:
+            status = 'regression'
+        elif warned:
+            status = 'warning'
+        elif latency_delta < -limit:
+            status = 'improvement'
+        else:
+            status = 'ok'
+        rows.append({'key': key, 'latency_delta': latency_delta, 'throughput_delta': throughput_delta,
+                     'mem_delta': mem_delta, 'limit': limit, 'mem_limit': mem_limit, 'regressed': regressed,
+                     'warned': warned, 'status': status})
+    return rows
@@ -0,0 +1,185 @@
+import json
+import os
+import time
+from collections import OrderedDict
+
+import torch
+
+
+def module_output_bytes(output):
+    """Number of bytes held by the tensors a module returned.
+
+    Args:
+        output (Tensor | tuple | list): Output of a module forward.
+
+    Returns:
+        int: Total bytes of all tensors in ``output``.
+    """
+    if torch.is_tensor(output):
+        return output.numel() * output.element_size()
+    if isinstance(output, (tuple, list)):
+        return sum(module_output_bytes(o) for o in output)
+    return 0
+
+
+def profiled_module_names(model):
+    """Select the SwinIR modules worth timing individually.
+
+    Covers the shallow conv, every RSTB, every SwinTransformerBlock together with its
+    attention and MLP, ``conv_after_body`` and the reconstruction (upsampler) modules.
+
+    Args:
+        model (nn.Module): A SwinIR model.
+
+    Returns:
+        list[str]: Module names, in forward order, as given by ``model.named_modules()``.
+    """
+    recon = ('conv_before_upsample', 'upsample', 'conv_up1', 'conv_up2', 'conv_hr', 'conv_last')
+    names = []
+    for name, _ in model.named_modules():
+        parts = name.split('.')
+        if name in ('conv_first', 'conv_after_body') or name in recon:
+            names.append(name)
+        elif len(parts) == 2 and parts[0] == 'layers':
+            # layers.{i}: RSTB
+            names.append(name)
+        elif len(parts) == 5 and parts[0] == 'layers' and parts[2:4] == ['residual_group', 'blocks']:
+            # layers.{i}.residual_group.blocks.{j}: SwinTransformerBlock
+            names.append(name)
+        elif len(parts) == 6 and parts[2:4] == ['residual_group', 'blocks'] and parts[5] in ('attn', 'mlp'):
+            names.append(name)
+    return names
+
+
+class SwinIRProfiler(object):
+    """Opt-in per-module profiler for SwinIR built on forward hooks.
+
+    Hooks are only registered between :meth:`attach` and :meth:`detach`, so a model that
+    is never attached runs exactly the same code as without the profiler.
+
+    For every hooked call the wall time and the bytes of the produced activations are
+    recorded; on CUDA the change in ``torch.cuda.memory_allocated`` over the call is recorded
+    as well. Calls are grouped per image (see :meth:`start_image`) and can
+    be exported as a Chrome trace (``chrome://tracing`` or https://ui.perfetto.dev).
+
+    Args:
+        model (nn.Module): The SwinIR model to profile.
+        module_names (list[str] | None): Modules to hook. Default: :func:`profiled_module_names`.
+    """
+
+    def __init__(self, model, module_names=None):
+        self.model = model
+        self.module_names = module_names if module_names is not None else profiled_module_names(model)
+        self.handles = []
+        self.events = []
+        self.images = OrderedDict()
+        self.current_image = None
+        self._stack = []
+        self._origin = time.perf_counter()
+
+    def attach(self):
+        modules = dict(self.model.named_modules())
+        for name in self.module_names:
+            module = modules[name]
+            self.handles.append(module.register_forward_pre_hook(self._make_pre_hook(name)))
+            self.handles.append(module.register_forward_hook(self._make_post_hook(name)))
+        return self
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def start_image(self, name):
+        self.current_image = name
+        self.images.setdefault(name, OrderedDict())
+
+    def _sync(self, tensor):
+        if tensor is not None and tensor.is_cuda:
+            torch.cuda.synchronize(tensor.device)
+
+    def _make_pre_hook(self, name):
+        def hook(module, inputs):
+            x = inputs[0] if inputs and torch.is_tensor(inputs[0]) else None
+            self._sync(x)
+            cuda_mem = None
+            if x is not None and x.is_cuda:
+                cuda_mem = torch.cuda.memory_allocated(x.device)
+            self._stack.append((name, time.perf_counter(), cuda_mem))
+        return hook
+
+    def _make_post_hook(self, name):
+        def hook(module, inputs, output):
+            out = output if torch.is_tensor(output) else None
+            self._sync(out)
+            end = time.perf_counter()
+            _, start, cuda_mem = self._stack.pop()
+
+            record = {'name': name, 'image': self.current_image,
+                      'start': start - self._origin, 'dur': end - start,
+                      'out_bytes': module_output_bytes(output)}
+            if cuda_mem is not None:
+                device = out.device if out is not None else None
+                record['alloc_bytes'] = torch.cuda.memory_allocated(device) - cuda_mem
+            self.events.append(record)
+
+            stats = self.images.setdefault(self.current_image, OrderedDict()).setdefault(
+                name, {'calls': 0, 'time': 0., 'out_bytes': 0, 'alloc_bytes': 0})
+            stats['calls'] += 1
+            stats['time'] += record['dur']
+            stats['out_bytes'] += record['out_bytes']
+            stats['alloc_bytes'] += record.get('alloc_bytes', 0)
+        return hook
+
+    def summary(self, image=None):
+        """Aggregate the recorded calls per module.
+
+        Args:
+            image (str | None): Restrict to one image. Default: all images.
+
+        Returns:
+            OrderedDict: module name -> dict(calls, time, out_bytes, alloc_bytes), in forward order.
+        """
+        if image is not None:
+            total = self.images.get(image, {})
+        else:
+            total = self._merge_images()
+        return OrderedDict((name, total[name]) for name in self.module_names if name in total)
+
+    def _merge_images(self):
+        total = {}
+        for stats in self.images.values():
+            for name, s in stats.items():
+                t = total.setdefault(name, {'calls': 0, 'time': 0., 'out_bytes': 0, 'alloc_bytes': 0})
+                for k in t:
+                    t[k] += s[k]
+        return total
+
+    def print_summary(self, image=None):
+        stats = self.summary(image)
+        print('{:45s} {:>6s} {:>11s} {:>11s} {:>12s} {:>12s}'.format(
+            'module', 'calls', 'total ms', 'mean ms', 'out MB', 'alloc MB'))
+        for name, s in stats.items():
+            print('{:45s} {:6d} {:11.2f} {:11.3f} {:12.2f} {:12.2f}'.format(
+                name, s['calls'], s['time'] * 1e3, s['time'] * 1e3 / s['calls'],
+                s['out_bytes'] / 2 ** 20, s['alloc_bytes'] / 2 ** 20))
+
+    def export_chrome_trace(self, path):
+        """Write the recorded calls as a Chrome trace JSON (one complete event per call)."""
+        trace = []
+        for record in self.events:
+            args = {k: record[k] for k in ('image', 'out_bytes', 'alloc_bytes') if k in record}
+            trace.append({'name': record['name'], 'cat': record['name'].split('.')[-1], 'ph': 'X',
+                          'ts': record['start'] * 1e6, 'dur': record['dur'] * 1e6,
+                          'pid': os.getpid(), 'tid': 0, 'args': args})
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+
+
+STREAM_EXTENSIONS = ('.npy', '.tif', '.tiff')
+
+
+def open_image_memmap(path, shape=None, dtype=np.uint8):
+    """Memory-map an HW or HWC image for reading: .npy, .tif/.tiff (needs tifffile) or raw pixels of the given shape.
+
+    Only the rows that are indexed are read from disk. Uncompressed TIFFs are mapped directly;
+    compressed or tiled ones are decoded once into a temporary memory map on disk, so they do
+    not have to fit in memory either. Shared by main_test_swinir.py --stream and
+    ColumnNormalization.py --normalize.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        return np.load(path, mmap_mode='r')
+    if ext in ('.tif', '.tiff'):
+        import tifffile
+        try:
+            return tifffile.memmap(path, mode='r')
+        except ValueError:
+            return tifffile.imread(path, out='memmap')
+    if shape is None:
+        raise ValueError(f'{path}: a raw image needs its shape, or use one of {", ".join(STREAM_EXTENSIONS)}')
+    return np.memmap(path, dtype=dtype, mode='r', shape=tuple(shape))
+
+
+def create_image_memmap(path, shape, dtype=np.uint8):
+    """Writable memory-mapped HW or HWC output image: .npy, uncompressed .tif/.tiff (needs tifffile) or raw pixels.
+
+    Rows written to it go to disk as the memory map is flushed, so the image never has to be held
+    in memory.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+    if ext in ('.tif', '.tiff'):
+        import tifffile
+        return tifffile.memmap(path, shape=tuple(shape), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='w+', shape=tuple(shape))
+
+
+def value_range(dtype):
+    """Value of white for an image dtype: the integer maximum, 1 for floats."""
+    return float(np.iinfo(dtype).max) if np.issubdtype(dtype, np.integer) else 1.
+
+
+def reflect_index(size, valid):
+    """Source indices of a padded axis of length size, mirroring the valid pixels at the end.
+
+    Same as torch.cat([x, torch.flip(x, [dim])], dim)[:size] in main_test_swinir.py.
+    """
+    index = np.arange(size)
+    return np.where(index < valid, index, 2 * valid - 1 - index)